@@ -1,7 +1,6 @@
 #!/usr/bin/env python
 import optparse, sys, os, logging
-from collections import defaultdict
-from itertools import islice
+import models
 
 optparser = optparse.OptionParser()
 optparser.add_option("-d", "--datadir", dest="datadir", default="data", help="data directory (default=data)")
@@ -10,6 +9,8 @@ optparser.add_option("-e", "--english", dest="english", default="en", help="suff
 optparser.add_option("-f", "--french", dest="french", default="fr", help="suffix of French (source language) filename (default=fr)")
 optparser.add_option("-l", "--logfile", dest="logfile", default=None, help="filename for logging output")
 optparser.add_option("-t", "--threshold", dest="threshold", default=0.5, type="float", help="threshold for alignment (default=0.5)")
+optparser.add_option("-w", "--workers", dest="workers", default=1, type="int", help="number of worker processes for counting (default=1)")
+optparser.add_option("-c", "--checkpoint", dest="checkpoint", default=None, help="directory of checkpointed counts and alignments to update with sentence pairs appended to the bitext (default=none)")
 optparser.add_option("-n", "--num_sentences", dest="num_sents", default=sys.maxsize, type="int", help="Number of sentences to use for training and alignment")
 (opts, _) = optparser.parse_args()
 f_data = "%s.%s" % (os.path.join(opts.datadir, opts.fileprefix), opts.french)
@@ -18,31 +19,21 @@ e_data = "%s.%s" % (os.path.join(opts.datadir, opts.fileprefix), opts.english)
 if opts.logfile:
     logging.basicConfig(filename=opts.logfile, filemode='w', level=logging.INFO)
 
+bitext = models.Corpus(f_data, e_data, opts.num_sents) # tokenized once into data/<prefix>.<f>-<e>.corpus
+(f_vocab, e_vocab) = (bitext.f_vocab, bitext.e_vocab)
 sys.stderr.write("Training with Dice's coefficient...")
-bitext = [[sentence.strip().split() for sentence in pair] for pair in islice(zip(open(f_data), open(e_data)), opts.num_sents)]
-f_count = defaultdict(int)
-e_count = defaultdict(int)
-fe_count = defaultdict(int)
-for (n, (f, e)) in enumerate(bitext):
-  for f_i in set(f):
-    f_count[f_i] += 1
-    for e_j in set(e):
-      fe_count[(f_i,e_j)] += 1
-  for e_j in set(e):
-    e_count[e_j] += 1
-  if n % 500 == 0:
-    sys.stderr.write(".")
+if opts.checkpoint:
+  store = models.CountStore(opts.checkpoint)
+  counts = store.update(bitext, len(f_vocab), len(e_vocab), opts.workers)
+  sys.stderr.write("\n")
+  realigned = store.align(bitext, counts, opts.threshold, sys.stdout)
+  sys.stderr.write("Counted %d new sentence pairs, realigned %d of %d old ones\n" % (len(bitext) - store.size, realigned, store.size))
+  sys.exit(0)
 
-dice = defaultdict(int)
-for (k, (f_i, e_j)) in enumerate(fe_count.keys()):
-  dice[(f_i,e_j)] = 2.0 * fe_count[(f_i, e_j)] / (f_count[f_i] + e_count[e_j])
-  if k % 5000 == 0:
-    sys.stderr.write(".")
+(f_count, e_count, fe_count) = models.cooccurrence_counts(bitext, len(f_vocab), len(e_vocab), workers=opts.workers)
+dice = models.dice(f_count, e_count, fe_count)
 sys.stderr.write("\n")
 
-for (f, e) in bitext:
-  for (i, f_i) in enumerate(f): 
-    for (j, e_j) in enumerate(e):
-      if dice[(f_i,e_j)] >= opts.threshold:
-        sys.stdout.write("%i-%i " % (i,j))
-  sys.stdout.write("\n")
+# look up the scores of all word pairs in a block of sentences at once
+for start in range(0, len(bitext), 10000):
+  sys.stdout.writelines(models.dice_alignments(bitext[start:start+10000], dice, opts.threshold))
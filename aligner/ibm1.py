@@ -0,0 +1,35 @@
+#!/usr/bin/env python
+import optparse, sys, os, logging
+import models
+
+optparser = optparse.OptionParser()
+optparser.add_option("-d", "--datadir", dest="datadir", default="data", help="data directory (default=data)")
+optparser.add_option("-p", "--prefix", dest="fileprefix", default="hansards", help="prefix of parallel data files (default=hansards)")
+optparser.add_option("-e", "--english", dest="english", default="en", help="suffix of English (target language) filename (default=en)")
+optparser.add_option("-f", "--french", dest="french", default="fr", help="suffix of French (source language) filename (default=fr)")
+optparser.add_option("-l", "--logfile", dest="logfile", default=None, help="filename for logging output")
+optparser.add_option("-i", "--iterations", dest="iterations", default=5, type="int", help="number of EM iterations (default=5)")
+optparser.add_option("-b", "--batch-size", dest="batch_size", default=1<<20, type="int", help="maximum number of padded word pairs in a training batch (default=1048576)")
+optparser.add_option("-w", "--workers", dest="workers", default=1, type="int", help="number of worker processes for the E-step (default=1)")
+optparser.add_option("-s", "--symmetrize", dest="symmetrize", action="store_true", default=False, help="train both directions and symmetrize with grow-diag-final (default=off)")
+optparser.add_option("-n", "--num_sentences", dest="num_sents", default=sys.maxsize, type="int", help="Number of sentences to use for training and alignment")
+(opts, _) = optparser.parse_args()
+f_data = "%s.%s" % (os.path.join(opts.datadir, opts.fileprefix), opts.french)
+e_data = "%s.%s" % (os.path.join(opts.datadir, opts.fileprefix), opts.english)
+
+if opts.logfile:
+    logging.basicConfig(filename=opts.logfile, filemode='w', level=logging.INFO)
+
+bitext = models.Corpus(f_data, e_data, opts.num_sents) # tokenized once into data/<prefix>.<f>-<e>.corpus
+(f_vocab, e_vocab) = (bitext.f_vocab, bitext.e_vocab)
+sys.stderr.write("Training IBM Model 1...\n")
+if opts.symmetrize:
+  (f2e, e2f) = models.train_both_directions(bitext, opts.iterations, opts.batch_size, opts.workers)
+  alignments = models.symmetrize(bitext, f2e, e2f)
+else:
+  ibm1 = models.IBMModel1(bitext, len(f_vocab), len(e_vocab), opts.batch_size)
+  ibm1.train(opts.iterations, opts.workers)
+  alignments = ibm1.align()
+
+for (i, j) in alignments:
+  sys.stdout.write("".join("%i-%i " % link for link in zip(i.tolist(), j.tolist())) + "\n")
@@ -0,0 +1,626 @@
+#!/usr/bin/env python
+# Data structures shared by the aligners
+import sys, os, time, resource, multiprocessing, hashlib, locale
+from itertools import islice
+import numpy as np
+import scipy.sparse as sp
+
+class Vocab:
+    """
+    Interns words as consecutive integer ids, so that counts can be kept
+    in arrays indexed by id instead of dicts keyed by strings or tuples.
+    """
+
+    def __init__(self):
+        self.ids = {}
+        self.words = []
+
+    def __len__(self):
+        return len(self.words)
+
+    def intern(self, word):
+        i = self.ids.get(word)
+        if i is None:
+            i = self.ids[word] = len(self.words)
+            self.words.append(word)
+        return i
+
+    def encode(self, words):
+        "Return the ids of a list of words as an int32 array, interning new words."
+        return np.array([self.intern(w) for w in words], dtype=np.int32)
+
+    def save(self, filename):
+        with open(filename, 'w') as f:
+            for word in self.words:
+                f.write(word + "\n")
+
+    @classmethod
+    def load(cls, filename):
+        vocab = cls()
+        with open(filename) as f:
+            for line in f:
+                vocab.intern(line.rstrip("\n"))
+        return vocab
+
+def prefix_hash(filename, size, block=1<<20):
+    "SHA-1 of the first size bytes of filename, as hex."
+    digest = hashlib.sha1()
+    with open(filename, 'rb') as f:
+        while size > 0:
+            data = f.read(min(block, size))
+            if not data:
+                break
+            digest.update(data)
+            size -= len(data)
+    return digest.hexdigest()
+
+class Corpus:
+    """
+    A bitext stored as integer ids, which is tokenized once and then
+    replayed from memory-mapped files on every later pass and run.
+
+    The first time a bitext is read it is streamed into a directory next
+    to it holding the f and e vocabularies and, for each side, a flat
+    int32 file of the word ids of all sentences plus an int64 file of
+    sentence offsets into it. Iterating yields (f, e) pairs of id arrays
+    that are views into the mapped files, and slicing gives a Corpus over
+    a range of sentences without copying.
+    """
+
+    def __init__(self, f_data, e_data, num_sents=sys.maxsize, cachedir=None):
+        self.cachedir = cachedir or "%s-%s.corpus" % (f_data, os.path.basename(e_data).split('.')[-1])
+        state = self._state()
+        sizes = (os.path.getsize(f_data), os.path.getsize(e_data))
+        mtimes = "%r %r" % (os.path.getmtime(f_data), os.path.getmtime(e_data))
+        if state is not None and state[0] == mtimes and (state[3] or state[2] >= num_sents):
+            pass
+        elif state is not None and state[3] and state[5] and sizes[0] >= state[1][0] and sizes[1] >= state[1][1]:
+            # the data files grew since they were read to the end: if the
+            # bytes read then are unchanged (and ended in whole lines),
+            # lines were appended, so only the new lines are tokenized
+            if (prefix_hash(f_data, state[1][0]), prefix_hash(e_data, state[1][1])) == state[4]:
+                self._tokenize(f_data, e_data, sys.maxsize, resume=state)
+            else:
+                sys.stderr.write("%s or %s was edited, not only appended to, since it was tokenized\n" % (f_data, e_data))
+                self._tokenize(f_data, e_data, num_sents)
+        else:
+            self._tokenize(f_data, e_data, num_sents)
+        self.f_vocab = Vocab.load(self._path("f.vocab"))
+        self.e_vocab = Vocab.load(self._path("e.vocab"))
+        self.f_ids = np.memmap(self._path("f.ids"), dtype='<i4', mode='r') if os.path.getsize(self._path("f.ids")) else np.zeros(0, dtype=np.int32)
+        self.e_ids = np.memmap(self._path("e.ids"), dtype='<i4', mode='r') if os.path.getsize(self._path("e.ids")) else np.zeros(0, dtype=np.int32)
+        self.f_offsets = np.fromfile(self._path("f.offsets"), dtype='<i8')
+        self.e_offsets = np.fromfile(self._path("e.offsets"), dtype='<i8')
+        (self.start, self.end) = (0, min(num_sents, len(self.f_offsets)-1))
+
+    def _path(self, name):
+        return os.path.join(self.cachedir, name)
+
+    def _state(self):
+        """
+        The data file mtimes, the bytes of each file read into sentence
+        pairs, the number of sentences, completeness, hashes of the data
+        files up to those bytes, and whether both ended in a newline there,
+        as recorded when the cache was built.
+        """
+        try:
+            with open(self._path("info")) as f:
+                (mtimes, sizes, size, complete, hashes, tail) = f.read().split("\t")
+            return (mtimes, tuple(map(int, sizes.split())), int(size), complete == "complete", tuple(hashes.split()), tail == "newline")
+        except (IOError, ValueError):
+            return None
+
+    def _tokenize(self, f_data, e_data, num_sents, resume=None):
+        "Tokenize the first num_sents sentence pairs, or with resume, the lines appended since."
+        sys.stderr.write("Tokenizing %s and %s into %s...\n" % (f_data, e_data, self.cachedir))
+        if not os.path.isdir(self.cachedir):
+            os.makedirs(self.cachedir)
+        mtimes = "%r %r" % (os.path.getmtime(f_data), os.path.getmtime(e_data))
+        # the files are read as bytes to know where the last pair ended, and
+        # decoded like open() would; a longer side's extra lines are not read
+        encoding = locale.getpreferredencoding(False)
+        (f_text, e_text) = (open(f_data, 'rb'), open(e_data, 'rb'))
+        if resume:
+            (f_vocab, e_vocab) = (Vocab.load(self._path("f.vocab")), Vocab.load(self._path("e.vocab")))
+            f_offsets = np.fromfile(self._path("f.offsets"), dtype='<i8').tolist()
+            e_offsets = np.fromfile(self._path("e.offsets"), dtype='<i8').tolist()
+            f_text.seek(resume[1][0])
+            e_text.seek(resume[1][1])
+            mode = 'ab'
+        else:
+            (f_vocab, e_vocab) = (Vocab(), Vocab())
+            (f_offsets, e_offsets) = ([0], [0])
+            mode = 'wb'
+        before = len(f_offsets) - 1
+        (f_read, e_read) = (f_text.tell(), e_text.tell())
+        tail = "newline"
+        with open(self._path("f.ids"), mode) as f_ids, open(self._path("e.ids"), mode) as e_ids:
+            for (f, e) in islice(zip(f_text, e_text), num_sents):
+                (f_read, e_read) = (f_read + len(f), e_read + len(e))
+                tail = "newline" if f.endswith(b"\n") and e.endswith(b"\n") else "open"
+                f = f_vocab.encode(f.decode(encoding).strip().split())
+                e = e_vocab.encode(e.decode(encoding).strip().split())
+                f.astype('<i4').tofile(f_ids)
+                e.astype('<i4').tofile(e_ids)
+                f_offsets.append(f_offsets[-1] + len(f))
+                e_offsets.append(e_offsets[-1] + len(e))
+        np.array(f_offsets, dtype='<i8').tofile(self._path("f.offsets"))
+        np.array(e_offsets, dtype='<i8').tofile(self._path("e.offsets"))
+        f_vocab.save(self._path("f.vocab"))
+        e_vocab.save(self._path("e.vocab"))
+        size = len(f_offsets) - 1
+        f_text.close()
+        e_text.close()
+        hashes = (prefix_hash(f_data, f_read), prefix_hash(e_data, e_read))
+        with open(self._path("info"), 'w') as f:
+            f.write("%s\t%d %d\t%d\t%s\t%s %s\t%s" % (mtimes, f_read, e_read, size, "complete" if size - before < num_sents else "partial", hashes[0], hashes[1], tail))
+
+    def digest(self, end):
+        "SHA-1, as hex, of the word ids of the sentence pairs before end."
+        digest = hashlib.sha1()
+        for (ids, offsets) in ((self.f_ids, self.f_offsets), (self.e_ids, self.e_offsets)):
+            lengths = np.diff(offsets[self.start:self.start+end+1])
+            digest.update(lengths.astype('<i8').tobytes())
+            digest.update(np.ascontiguousarray(ids[offsets[self.start]:offsets[self.start+end]], dtype='<i4').tobytes())
+        return digest.hexdigest()
+
+    def sentences_with_f(self, words, end):
+        "Indices of the sentences before end that contain any of the f word ids in words."
+        positions = np.flatnonzero(np.isin(self.f_ids[self.f_offsets[self.start]:self.f_offsets[self.start+end]], words))
+        return np.unique(np.searchsorted(self.f_offsets[self.start:self.start+end+1], self.f_offsets[self.start] + positions, side='right') - 1)
+
+    def __len__(self):
+        return self.end - self.start
+
+    def __getitem__(self, n):
+        if isinstance(n, slice):
+            (start, end, _) = n.indices(len(self))
+            view = object.__new__(Corpus)
+            view.__dict__.update(self.__dict__)
+            (view.start, view.end) = (self.start + start, self.start + max(start, end))
+            return view
+        if n < 0:
+            n += len(self)
+        if not 0 <= n < len(self):
+            raise IndexError(n)
+        n += self.start
+        return (self.f_ids[self.f_offsets[n]:self.f_offsets[n+1]], self.e_ids[self.e_offsets[n]:self.e_offsets[n+1]])
+
+    def __iter__(self):
+        for n in range(self.start, self.end):
+            yield (self.f_ids[self.f_offsets[n]:self.f_offsets[n+1]], self.e_ids[self.e_offsets[n]:self.e_offsets[n+1]])
+
+    def swapped(self):
+        "A view of this corpus with the f and e sides exchanged, sharing the same ids."
+        view = self[:]
+        (view.f_vocab, view.e_vocab) = (self.e_vocab, self.f_vocab)
+        (view.f_ids, view.e_ids) = (self.e_ids, self.f_ids)
+        (view.f_offsets, view.e_offsets) = (self.e_offsets, self.f_offsets)
+        return view
+
+# Data that forked worker processes need is stored here before the pool
+# is created, so that workers share it copy-on-write instead of having
+# it pickled to them with every task.
+_shared = {}
+
+def fork_pool(workers, **shared):
+    _shared.update(shared)
+    return multiprocessing.get_context('fork').Pool(workers)
+
+def _count_shard(k):
+    (bitext, f_vocab_size, e_vocab_size, workers) = _shared['counts']
+    (start, end) = (len(bitext)*k//workers, len(bitext)*(k+1)//workers)
+    return cooccurrence_counts(bitext[start:end], f_vocab_size, e_vocab_size)
+
+def cooccurrence_counts(bitext, f_vocab_size, e_vocab_size, chunk=10000, workers=1):
+    """
+    Count in how many sentence pairs of bitext (pairs of f and e id arrays)
+    each f word, each e word and each (f, e) pair of words occurs. Returns
+    (f_count, e_count, fe_count) where fe_count is a CSR matrix with f ids
+    as rows and e ids as columns. Pairs are collected for chunk sentences
+    at a time and summed in bulk through a COO matrix. With workers > 1,
+    each worker process counts a contiguous part of bitext and the
+    partial counts are summed.
+    """
+    if workers > 1:
+        with fork_pool(workers, counts=(bitext, f_vocab_size, e_vocab_size, workers)) as pool:
+            parts = pool.map(_count_shard, range(workers))
+        return tuple(sum(counts) for counts in zip(*parts))
+    f_count = np.zeros(f_vocab_size, dtype=np.int64)
+    e_count = np.zeros(e_vocab_size, dtype=np.int64)
+    fe_count = sp.csr_matrix((f_vocab_size, e_vocab_size), dtype=np.int64)
+    (rows, cols) = ([], [])
+    def flush():
+        if rows:
+            (r, c) = (np.concatenate(rows), np.concatenate(cols))
+            counts = sp.coo_matrix((np.ones(len(r), dtype=np.int64), (r, c)), shape=fe_count.shape)
+            del rows[:], cols[:]
+            return fe_count + counts.tocsr()
+        return fe_count
+    for (n, (f, e)) in enumerate(bitext):
+        (f, e) = (np.unique(f), np.unique(e))
+        f_count[f] += 1
+        e_count[e] += 1
+        rows.append(np.repeat(f, len(e)))
+        cols.append(np.tile(e, len(f)))
+        if len(rows) == chunk:
+            fe_count = flush()
+        if n % 500 == 0:
+            sys.stderr.write(".")
+    fe_count = flush()
+    return (f_count, e_count, fe_count)
+
+class PairTable:
+    """
+    A sparse table of values for (f, e) id pairs, stored as the sorted
+    keys f*E+e of the nonzero entries of a matrix and a parallel array of
+    values, so that whole arrays of pairs are looked up with one
+    searchsorted instead of one dict probe per pair.
+    """
+
+    def __init__(self, keys, values, shape):
+        self.keys = keys
+        self.values = values
+        self.shape = shape
+
+    @classmethod
+    def from_matrix(cls, matrix):
+        m = sp.csr_matrix(matrix)
+        m.sum_duplicates()
+        rows = np.repeat(np.arange(m.shape[0], dtype=np.int64), np.diff(m.indptr))
+        return cls(rows * m.shape[1] + m.indices, m.data, m.shape)
+
+    def rows(self):
+        return self.keys // self.shape[1]
+
+    def cols(self):
+        return self.keys % self.shape[1]
+
+    def find(self, rows, cols):
+        "Positions of the pairs (rows[k], cols[k]) in the table, which must all be in it."
+        return np.searchsorted(self.keys, np.asarray(rows, dtype=np.int64) * self.shape[1] + cols)
+
+    def __len__(self):
+        return len(self.keys)
+
+    def lookup(self, rows, cols, default=0.0):
+        "Values for the pairs (rows[k], cols[k]), and default for pairs not in the table."
+        keys = np.asarray(rows, dtype=np.int64) * self.shape[1] + cols
+        if len(self.keys) == 0:
+            return np.full(len(keys), default)
+        pos = np.minimum(np.searchsorted(self.keys, keys), len(self.keys)-1)
+        return np.where(self.keys[pos] == keys, self.values[pos], default)
+
+def all_pairs(bitext):
+    """
+    Every (i, j) position pair of every sentence pair in bitext, in order.
+    Returns the f ids, e ids, i and j arrays of all pairs and the offset
+    of the first pair of each sentence (plus the total at the end).
+    """
+    sizes = np.array([len(f)*len(e) for (f, e) in bitext], dtype=np.int64)
+    offsets = np.concatenate([[0], np.cumsum(sizes)])
+    (rows, cols, i, j) = ([], [], [], [])
+    for (f, e) in bitext:
+        rows.append(np.repeat(f, len(e)))
+        cols.append(np.tile(e, len(f)))
+        i.append(np.repeat(np.arange(len(f), dtype=np.int32), len(e)))
+        j.append(np.tile(np.arange(len(e), dtype=np.int32), len(f)))
+    concat = lambda a: np.concatenate(a) if a else np.zeros(0, dtype=np.int32)
+    return (concat(rows), concat(cols), concat(i), concat(j), offsets)
+
+def alignment_lines(i, j, offsets):
+    "The links (i[k], j[k]) of each sentence, split at offsets, as i-j lines."
+    links = ["%i-%i " % link for link in zip(i.tolist(), j.tolist())]
+    return ["".join(links[start:end]) + "\n" for (start, end) in zip(offsets[:-1], offsets[1:])]
+
+def dice_alignments(bitext, dice, threshold):
+    "Alignment lines for bitext, linking every (i, j) whose Dice score reaches threshold."
+    (f_ids, e_ids, i, j, offsets) = all_pairs(bitext)
+    aligned = dice.lookup(f_ids, e_ids) >= threshold
+    return alignment_lines(i[aligned], j[aligned], np.searchsorted(np.flatnonzero(aligned), offsets))
+
+def dice(f_count, e_count, fe_count):
+    "Dice's coefficient 2*c(f,e)/(c(f)+c(e)) for every co-occurring pair, as a PairTable."
+    rows = np.repeat(np.arange(fe_count.shape[0]), np.diff(fe_count.indptr))
+    cols = fe_count.indices
+    scores = 2.0 * fe_count.data / (f_count[rows] + e_count[cols])
+    return PairTable.from_matrix(sp.csr_matrix((scores, cols.copy(), fe_count.indptr.copy()), shape=fe_count.shape))
+
+def resize_counts(counts, f_vocab_size, e_vocab_size):
+    "Pad (f_count, e_count, fe_count) with zeros for words added to the vocabularies."
+    (f_count, e_count, fe_count) = counts
+    indptr = np.concatenate([fe_count.indptr, np.full(f_vocab_size - fe_count.shape[0], fe_count.indptr[-1])])
+    return (np.concatenate([f_count, np.zeros(f_vocab_size - len(f_count), dtype=f_count.dtype)]),
+            np.concatenate([e_count, np.zeros(e_vocab_size - len(e_count), dtype=e_count.dtype)]),
+            sp.csr_matrix((fe_count.data, fe_count.indices, indptr), shape=(f_vocab_size, e_vocab_size)))
+
+class CountStore:
+    """
+    A checkpoint of the Dice counts of the first `size` sentence pairs of
+    a bitext and of the alignments last emitted for them. When sentence
+    pairs are appended to the bitext, only the new ones are counted, and
+    of the old sentences only those that contain an f word of a pair
+    whose score crossed the threshold are aligned again.
+
+    The checkpoint keeps a digest of the word ids of the sentences it
+    counted. If the bitext no longer starts with them (it was edited, or
+    re-tokenized with other ids), the checkpoint is thrown away and all
+    of the bitext is counted and aligned again.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        (self.size, self.threshold, self.counts, self.digest) = (0, None, None, None)
+        if os.path.exists(os.path.join(path, "counts.npz")):
+            saved = np.load(os.path.join(path, "counts.npz"))
+            (self.size, self.threshold) = (int(saved["size"]), float(saved["threshold"]))
+            fe_count = sp.csr_matrix((saved["data"], saved["indices"], saved["indptr"]), shape=tuple(saved["shape"]))
+            self.counts = (saved["f_count"], saved["e_count"], fe_count)
+            self.digest = str(saved["digest"]) if "digest" in saved else None
+
+    def update(self, bitext, f_vocab_size, e_vocab_size, workers=1):
+        "Count the sentence pairs appended to bitext since the checkpoint and return the counts for all of it."
+        if self.counts is not None and (len(bitext) < self.size or self.digest != bitext.digest(self.size)):
+            sys.stderr.write("\nThe bitext does not start with the %d sentence pairs checkpointed in %s, counting it all again\n" % (self.size, self.path))
+            (self.size, self.threshold, self.counts, self.digest) = (0, None, None, None)
+        if self.counts is None:
+            self.counts = (np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64), sp.csr_matrix((0, 0), dtype=np.int64))
+        self.counts = resize_counts(self.counts, f_vocab_size, e_vocab_size)
+        new = cooccurrence_counts(bitext[self.size:], f_vocab_size, e_vocab_size, workers=workers)
+        return tuple(old + added for (old, added) in zip(self.counts, new))
+
+    def align(self, bitext, counts, threshold, out, block_size=10000):
+        """
+        Write Dice alignments of all of bitext under counts to out, reusing
+        the checkpointed lines of old sentences that cannot have changed,
+        and checkpoint the counts and alignments. Returns how many old
+        sentences were aligned again.
+        """
+        dice_scores = dice(*counts)
+        old_alignments = os.path.join(self.path, "alignments")
+        (changed, old) = (set(range(self.size)), None)
+        if self.threshold == threshold and os.path.exists(old_alignments):
+            with open(old_alignments) as f:
+                saved = sum(1 for line in f if line.endswith("\n"))
+            if saved >= self.size:
+                # a sentence can only change if one of its pairs crossed the threshold
+                before = dice(*self.counts).lookup(dice_scores.rows(), dice_scores.cols())
+                crossed = (before >= threshold) != (dice_scores.values >= threshold)
+                changed = set(bitext.sentences_with_f(np.unique(dice_scores.rows()[crossed]), self.size).tolist())
+                old = open(old_alignments)
+            else:
+                sys.stderr.write("%s has %d alignments but the checkpoint has %d sentence pairs, aligning them all again\n" % (old_alignments, saved, self.size))
+        if not os.path.isdir(self.path):
+            os.makedirs(self.path)
+        with open(old_alignments + ".tmp", 'w') as new:
+            for start in range(0, len(bitext), block_size):
+                sentences = range(start, min(start + block_size, len(bitext)))
+                lines = [next(old) if old and n < self.size else None for n in sentences]
+                todo = [n for n in sentences if n >= self.size or n in changed]
+                for (n, line) in zip(todo, dice_alignments([bitext[n] for n in todo], dice_scores, threshold)):
+                    lines[n - start] = line
+                out.writelines(lines)
+                new.writelines(lines)
+        if old:
+            old.close()
+        os.rename(old_alignments + ".tmp", old_alignments)
+        (f_count, e_count, fe_count) = counts
+        np.savez(os.path.join(self.path, "counts.npz"), size=len(bitext), threshold=threshold, digest=bitext.digest(len(bitext)), shape=fe_count.shape,
+                 f_count=f_count, e_count=e_count, data=fe_count.data, indices=fe_count.indices, indptr=fe_count.indptr)
+        return len([n for n in changed if n < self.size])
+
+def _e_step_shard(k):
+    (model, workers) = _shared['ibm1']
+    return model.e_step(model.batches[k::workers])
+
+class IBMModel1:
+    """
+    IBM Model 1 translation probabilities t(f|e), trained by EM.
+
+    Sentence pairs are sorted by length and grouped into batches of
+    padded id arrays (F is B x max|f|, E is B x 1+max|e| with the NULL
+    word in column 0, and -1 marks padding), so that the posteriors and
+    expected counts of a whole batch are computed by broadcasting. t is
+    a PairTable over the (f, e) pairs that co-occur in some sentence
+    pair, with e == e_vocab_size standing for NULL.
+    """
+
+    def __init__(self, bitext, f_vocab_size, e_vocab_size, batch_size=1<<20):
+        self.null = e_vocab_size
+        self.size = len(bitext)
+        self.batches = []
+        order = sorted(range(len(bitext)), key=lambda n: (len(bitext[n][0]), len(bitext[n][1])))
+        start = 0
+        while start < len(order):
+            # grow the batch while its padded B x |f| x |e| block stays under
+            # batch_size, where |f| and |e| are the longest in the batch
+            (f, e) = bitext[order[start]]
+            (max_f, max_e) = (len(f), len(e)+1)
+            end = start + 1
+            while end < len(order):
+                (f, e) = bitext[order[end]]
+                (longest_f, longest_e) = (max(max_f, len(f)), max(max_e, len(e)+1))
+                if (end+1-start) * longest_f * longest_e > batch_size:
+                    break
+                (max_f, max_e) = (longest_f, longest_e)
+                end += 1
+            sentences = np.array(order[start:end], dtype=np.int64)
+            F = np.full((len(sentences), max(len(bitext[n][0]) for n in sentences)), -1, dtype=np.int64)
+            E = np.full((len(sentences), 1 + max(len(bitext[n][1]) for n in sentences)), -1, dtype=np.int64)
+            E[:, 0] = self.null
+            for (b, n) in enumerate(sentences):
+                (f, e) = bitext[n]
+                F[b, :len(f)] = f
+                E[b, 1:len(e)+1] = e
+            self.batches.append((sentences, F, E))
+            start = end
+        keys = np.unique(np.concatenate([self._keys(F, E)[self._valid(F, E)] for (_, F, E) in self.batches] or [np.zeros(0, dtype=np.int64)]))
+        self.t = PairTable(keys, np.full(len(keys), 1.0 / max(f_vocab_size, 1)), (f_vocab_size, e_vocab_size+1))
+
+    def _valid(self, F, E):
+        return (F[:, :, None] >= 0) & (E[:, None, :] >= 0)
+
+    def _keys(self, F, E):
+        return F[:, :, None] * (self.null+1) + E[:, None, :]
+
+    def _posteriors(self, F, E):
+        "t(f_i|e_j) for every position pair of a batch, the valid mask and the table positions."
+        valid = self._valid(F, E)
+        pos = np.searchsorted(self.t.keys, self._keys(F, E)[valid])
+        T = np.zeros(valid.shape)
+        T[valid] = self.t.values[pos]
+        return (T, valid, pos)
+
+    def e_step(self, batches):
+        "Expected counts c(f, e) for each pair in t, and the log likelihood, over batches."
+        counts = np.zeros(len(self.t))
+        loglik = 0.0
+        for (_, F, E) in batches:
+            (T, valid, pos) = self._posteriors(F, E)
+            Z = T.sum(axis=2, keepdims=True)
+            f_valid = F >= 0
+            loglik += np.log(Z[f_valid]).sum() - (f_valid * np.log((E >= 0).sum(axis=1))[:, None]).sum()
+            Z[Z == 0] = 1.0
+            counts += np.bincount(pos, weights=(T / Z)[valid], minlength=len(self.t))
+        return (counts, loglik)
+
+    def m_step(self, counts):
+        "Renormalize expected counts into t(f|e) = c(f, e) / sum_f c(f, e)."
+        e = self.t.cols()
+        totals = np.bincount(e, weights=counts, minlength=self.t.shape[1])
+        self.t.values[:] = counts / np.where(totals[e] > 0, totals[e], 1.0)
+
+    def share(self):
+        "Move the values of t into shared memory, which forked workers see updated in place."
+        values = np.frombuffer(multiprocessing.RawArray('d', len(self.t)), dtype=np.float64)
+        values[:] = self.t.values
+        self.t.values = values
+
+    def train(self, iterations, workers=1, label=""):
+        """
+        Run EM, reporting time, log likelihood and memory use per iteration
+        on stderr. With workers > 1, the E-step runs in a pool of worker
+        processes over interleaved shares of the batches, reading t from
+        shared memory, and their expected counts are summed before the
+        M-step.
+        """
+        e_step = self.e_step
+        if workers > 1:
+            self.share()
+            pool = fork_pool(workers, ibm1=(self, workers))
+            def e_step(batches):
+                parts = pool.map(_e_step_shard, range(workers))
+                return (sum(counts for (counts, _) in parts), sum(loglik for (_, loglik) in parts))
+        for it in range(iterations):
+            start = time.time()
+            (counts, loglik) = e_step(self.batches)
+            self.m_step(counts)
+            sys.stderr.write("%sIteration %d: log likelihood %.2f, %.2f sec, t table %.1f MB, peak memory %.1f MB\n" % (
+                label, it+1, loglik, time.time() - start, (self.t.keys.nbytes + self.t.values.nbytes) / 2.0**20,
+                resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0))
+        if workers > 1:
+            pool.close()
+            pool.join()
+
+    def align(self):
+        """
+        The most probable e position for every f position of every
+        sentence pair (or none if NULL is most probable). Returns
+        alignments[n] = (i, j) arrays of links, in bitext order.
+        """
+        alignments = [None] * self.size
+        for (sentences, F, E) in self.batches:
+            (T, _, _) = self._posteriors(F, E)
+            best = T.argmax(axis=2)
+            for (b, n) in enumerate(sentences):
+                i = np.flatnonzero((best[b] > 0) & (F[b] >= 0))
+                alignments[n] = (i, best[b, i] - 1)
+        return alignments
+
+def _train_direction(bitext, iterations, batch_size, workers, label, conn):
+    model = IBMModel1(bitext, len(bitext.f_vocab), len(bitext.e_vocab), batch_size)
+    model.train(iterations, workers, label)
+    conn.send(model.align())
+    conn.close()
+
+def train_both_directions(bitext, iterations, batch_size=1<<20, workers=1):
+    """
+    Train IBM Model 1 in the f->e and e->f directions at the same time
+    in two forked processes, which share the interned corpus. Returns
+    the Viterbi alignments of both as lists of (i, j) arrays with i
+    indexing f and j indexing e.
+    """
+    ctx = multiprocessing.get_context('fork')
+    (alignments, processes) = ([], [])
+    for (corpus, label) in ((bitext, "f->e "), (bitext.swapped(), "e->f ")):
+        (recv, send) = ctx.Pipe(False)
+        process = ctx.Process(target=_train_direction, args=(corpus, iterations, batch_size, workers, label, send))
+        process.start()
+        # the child now holds the only sending end, so that recv() raises
+        # EOFError instead of blocking forever if the child dies
+        send.close()
+        alignments.append(recv)
+        processes.append(process)
+    results = []
+    for (recv, process, label) in zip(alignments, processes, ("f->e", "e->f")):
+        try:
+            results.append(recv.recv())
+        except EOFError:
+            process.join()
+            for other in processes:
+                if other.is_alive():
+                    other.terminate()
+            raise RuntimeError("training the %s model failed (its process exited with code %s)" % (label, process.exitcode))
+    for process in processes:
+        process.join()
+    (f2e, e2f) = results
+    return (f2e, [(i, j) for (j, i) in e2f])
+
+def _shift(A, di, dj):
+    "A[:, i-di, j-dj] at every (i, j) of a stack of matrices, and False off the edges."
+    S = np.zeros_like(A)
+    (I, J) = A.shape[1:]
+    S[:, max(di,0):I+min(di,0), max(dj,0):J+min(dj,0)] = A[:, max(-di,0):I+min(-di,0), max(-dj,0):J+min(-dj,0)]
+    return S
+
+neighbors = [(-1, 0), (0, -1), (1, 0), (0, 1), (-1, -1), (-1, 1), (1, -1), (1, 1)]
+
+def grow_diag_final(f2e, e2f):
+    """
+    Symmetrize a stack of f->e and e->f alignment matrices (boolean
+    arrays of shape sentences x |f| x |e|) with grow-diag-final: start
+    from their intersection, repeatedly add points of their union that
+    neighbor an aligned point and have an unaligned row or column, then
+    add the remaining points of each direction with an unaligned row or
+    column. Each round adds all the points that qualify at once, rather
+    than one at a time in a fixed order.
+    """
+    A = f2e & e2f
+    union = f2e | e2f
+    while True:
+        adjacent = np.zeros_like(A)
+        for (di, dj) in neighbors:
+            adjacent |= _shift(A, di, dj)
+        unaligned = ~A.any(axis=2)[:, :, None] | ~A.any(axis=1)[:, None, :]
+        new = union & ~A & adjacent & unaligned
+        if not new.any():
+            break
+        A |= new
+    for D in (e2f, f2e):
+        A |= D & (~A.any(axis=2)[:, :, None] | ~A.any(axis=1)[:, None, :])
+    return A
+
+def symmetrize(bitext, f2e, e2f, block_size=1000):
+    "Combine two lists of (i, j) alignments of bitext with grow_diag_final, a block of sentences at a time."
+    alignments = []
+    for start in range(0, len(bitext), block_size):
+        block = bitext[start:start+block_size]
+        I = max([len(f) for (f, _) in block] or [0])
+        J = max([len(e) for (_, e) in block] or [0])
+        (F2E, E2F) = (np.zeros((len(block), I, J), dtype=bool), np.zeros((len(block), I, J), dtype=bool))
+        for b in range(len(block)):
+            F2E[(b,) + tuple(f2e[start+b])] = True
+            E2F[(b,) + tuple(e2f[start+b])] = True
+        A = grow_diag_final(F2E, E2F)
+        alignments.extend(np.nonzero(A[b]) for b in range(len(block)))
+    return alignments
@@ -1,5 +1,6 @@
 #!/usr/bin/env python
-import optparse, sys, os
+import optparse, sys, os, logging
+import numpy as np
 
 optparser = optparse.OptionParser()
 optparser.add_option("-d", "--datadir", dest="datadir", default="data", help="data directory (default=data)")
@@ -21,41 +22,81 @@ if opts.logfile:
 
 inp = sys.stdin if opts.inputfile is None else open(opts.inputfile, 'r')
 
-(size_a, size_s, size_a_and_s, size_a_and_p) = (0.0,0.0,0.0,0.0)
-for (i, (f, e, g, a)) in enumerate(zip(open(f_data), open(e_data), open(a_data), inp)):
+# Links are scored in blocks of lines. Each block is tokenized in one
+# pass by turning "i-j" into "i 0 j" and "i?j" into "i 1 j" and parsing
+# all numbers at once, and every link is packed into one integer
+# n*W*W + i*W + j (n = line within the block). Set intersections then
+# become merges of sorted integer arrays over the whole block.
+W = 1 << 20
+block_size = 10000
+
+def links(lines):
+  "Packed keys and separators (0 for '-', 1 for '?') of all links in lines."
+  counts = [line.count("-") + line.count("?") for line in lines]
+  numbers = np.fromstring(" ".join(lines).replace("-", " 0 ").replace("?", " 1 "), dtype=np.int64, sep=" ")
+  if len(numbers) != 3 * sum(counts):
+    raise ValueError("Lines can contain only tokens \"i-j\" and \"i?j\"")
+  numbers = numbers.reshape(-1, 3)
+  n = np.repeat(np.arange(len(lines), dtype=np.int64), counts)
+  return (n * W * W + numbers[:,0] * W + numbers[:,2], numbers[:,1])
+
+def sorted_set(keys):
+  keys = np.sort(keys)
+  return keys[np.concatenate(([True], keys[1:] != keys[:-1]))] if len(keys) else keys
+
+def score_block(golds, guesses):
+  "Return |A|, |S|, |A & S| and |A & P| + |A & S| for a block of gold and guessed alignment lines."
+  (gold, separator) = links(golds)
+  sure = sorted_set(gold[separator == 0])
+  possible = sorted_set(gold[separator == 1])
+  alignment = sorted_set(links(guesses)[0])
+  a_and_s = len(np.intersect1d(alignment, sure, assume_unique=True))
+  a_and_p = len(np.intersect1d(alignment, possible, assume_unique=True)) + a_and_s
+  return np.array([len(alignment), len(sure), a_and_s, a_and_p], dtype=np.float64)
+
+def display(i, f, e, g, a):
   fwords = f.strip().split()
   ewords = e.strip().split()
   sure = set([tuple(map(int, x.split("-"))) for x in filter(lambda x: x.find("-") > -1, g.strip().split())])
   possible = set([tuple(map(int, x.split("?"))) for x in filter(lambda x: x.find("?") > -1, g.strip().split())])
   alignment = set([tuple(map(int, x.split("-"))) for x in a.strip().split()])
-  size_a += len(alignment)
-  size_s += len(sure)
-  size_a_and_s += len(alignment & sure)
-  size_a_and_p += len(alignment & possible) + len(alignment & sure)
-  if (i<opts.n):
-    sys.stdout.write("  Alignment %i  KEY: ( ) = guessed, * = sure, ? = possible\n" % i)
+  sys.stdout.write("  Alignment %i  KEY: ( ) = guessed, * = sure, ? = possible\n" % i)
+  sys.stdout.write("  ")
+  for j in ewords:
+    sys.stdout.write("---")
+  sys.stdout.write("\n")
+  for (i, f_i) in enumerate(fwords):
+    sys.stdout.write(" |")
+    for (j, _) in enumerate(ewords):
+      (left,right) = ("(",")") if (i,j) in alignment else (" "," ")
+      point = "*" if (i,j) in sure else "?" if (i,j) in possible else " "
+      sys.stdout.write("%s%s%s" % (left,point,right))
+    sys.stdout.write(" | %s\n" % f_i)
+  sys.stdout.write("  ")
+  for j in ewords:
+    sys.stdout.write("---")
+  sys.stdout.write("\n")
+  for k in range(max(map(len, ewords))):
     sys.stdout.write("  ")
-    for j in ewords:
-      sys.stdout.write("---")
-    sys.stdout.write("\n")
-    for (i, f_i) in enumerate(fwords):
-      sys.stdout.write(" |")
-      for (j, _) in enumerate(ewords):
-        (left,right) = ("(",")") if (i,j) in alignment else (" "," ")
-        point = "*" if (i,j) in sure else "?" if (i,j) in possible else " "
-        sys.stdout.write("%s%s%s" % (left,point,right))
-      sys.stdout.write(" | %s\n" % f_i)
-    sys.stdout.write("  ")
-    for j in ewords:
-      sys.stdout.write("---")
-    sys.stdout.write("\n")
-    for k in range(max(map(len, ewords))):
-      sys.stdout.write("  ")
-      for word in ewords:
-        letter = word[k] if len(word) > k else " "
-        sys.stdout.write(" %s " % letter)
-      sys.stdout.write("\n")
+    for word in ewords:
+      letter = word[k] if len(word) > k else " "
+      sys.stdout.write(" %s " % letter)
     sys.stdout.write("\n")
+  sys.stdout.write("\n")
+
+sizes = np.zeros(4)
+(golds, guesses) = ([], [])
+for (i, (f, e, g, a)) in enumerate(zip(open(f_data), open(e_data), open(a_data), inp)):
+  golds.append(g)
+  guesses.append(a)
+  if len(golds) == block_size:
+    sizes += score_block(golds, guesses)
+    (golds, guesses) = ([], [])
+  if (i<opts.n):
+    display(i, f, e, g, a)
+if golds:
+  sizes += score_block(golds, guesses)
+(size_a, size_s, size_a_and_s, size_a_and_p) = sizes
 
 precision = size_a_and_p / size_a
 recall = size_a_and_s / size_s
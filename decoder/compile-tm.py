@@ -0,0 +1,25 @@
+#!/usr/bin/env python
+"""
+Compile a translation model once into a binary file that the decoder and
+score-decoder.py mmap instead of parsing it on every run:
+
+    python compile-tm.py
+
+writes data/tm.bin, which models.load_tm then picks up automatically.
+With -k only the top k translations of each phrase are kept; the file is
+then used only by runs that ask for at most k translations per phrase.
+"""
+import sys, optparse
+import models
+
+optparser = optparse.OptionParser()
+optparser.add_option("-t", "--translation-model", dest="tm", default="data/tm", help="File containing translation model (default=data/tm)")
+optparser.add_option("-k", "--translations-per-phrase", dest="k", default=0, type="int", help="Keep only the top k translations of each phrase (default=keep all)")
+optparser.add_option("-o", "--output", dest="output", default=None, help="Compiled file to write (default=<translation model>.bin)")
+opts = optparser.parse_args()[0]
+
+output = opts.output or models.compiled_tm_name(opts.tm)
+data = models.compile_tm(opts.tm, opts.k)
+with open(output, 'wb') as f:
+  f.write(data)
+sys.stderr.write("Wrote %d bytes to %s\n" % (len(data), output))
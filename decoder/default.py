@@ -1,8 +1,11 @@
 #!/usr/bin/env python
 import optparse
 import sys
+import heapq
+import time
+import json
+import functools
 import models
-from collections import namedtuple
 
 optparser = optparse.OptionParser()
 optparser.add_option("-i", "--input", dest="input", default="data/input", help="File containing sentences to translate (default=data/input)")
@@ -11,51 +14,313 @@ optparser.add_option("-l", "--language-model", dest="lm", default="data/lm", hel
 optparser.add_option("-n", "--num_sentences", dest="num_sents", default=sys.maxint, type="int", help="Number of sentences to decode (default=no limit)")
 optparser.add_option("-k", "--translations-per-phrase", dest="k", default=1, type="int", help="Limit on number of translations to consider per phrase (default=1)")
 optparser.add_option("-s", "--stack-size", dest="s", default=1, type="int", help="Maximum stack size (default=1)")
+optparser.add_option("-b", "--beam", dest="beam", default=float('inf'), type="float", help="Prune hypotheses that score more than this below the best one in their stack (default=no limit)")
+optparser.add_option("-d", "--distortion-limit", dest="d", default=0, type="int", help="Maximum distance between the end of one phrase and the start of the next (default=0, monotone)")
+optparser.add_option("--array-lm", dest="array_lm", action="store_true", default=False, help="Read the language model into flat arrays (models.ArrayLM) instead of a dict: less memory for large models, float32 scores (default=off)")
+optparser.add_option("-c", "--lm-cache-size", dest="lm_cache", default=1000000, type="int", help="Number of LM scores of words and of phrases to memoize (default=1000000)")
+optparser.add_option("--nbest", dest="nbest", default=0, type="int", help="Write the N best distinct translations of each sentence as 'i ||| translation ||| LM TM' lines instead of the best one (default=off)")
+optparser.add_option("--lattice", dest="lattice", default=None, help="File to write the search graph of each sentence to (default=none)")
+optparser.add_option("--stats", dest="stats", default=None, help="File to write search statistics to, as one JSON object per sentence and one for the whole input (default=none)")
+optparser.add_option("-w", "--workers", dest="workers", default=1, type="int", help="Number of worker processes decoding sentences in parallel (default=1)")
 optparser.add_option("-v", "--verbose", dest="verbose", action="store_true", default=False,  help="Verbose mode (default=off)")
 opts = optparser.parse_args()[0]
 
-tm = models.TM(opts.tm, opts.k)
-lm = models.LM(opts.lm)
+tm = models.load_tm(opts.tm, opts.k)
+lm = models.LMCache(models.ArrayLM(opts.lm) if opts.array_lm else models.LM(opts.lm), opts.lm_cache)
 french = [tuple(line.strip().split()) for line in open(opts.input).readlines()[:opts.num_sents]]
 
 # tm should translate unknown words as-is with probability 1
 for word in set(sum(french,())):
   if (word,) not in tm:
     tm[(word,)] = [models.phrase(word, 0.0)]
+maxlen = models.max_phrase_length(tm)
 
-sys.stderr.write("Decoding %s...\n" % (opts.input,))
-for f in french:
-  # The following code implements a monotone decoding
-  # algorithm (one that doesn't permute the target phrases).
-  # Hence all hypotheses in stacks[i] represent translations of 
-  # the first i words of the input sentence. You should generalize
-  # this so that they can represent translations of *any* i words.
-  hypothesis = namedtuple("hypothesis", "logprob, lm_state, predecessor, phrase")
-  initial_hypothesis = hypothesis(0.0, lm.begin(), None, None)
-  stacks = [{} for _ in f] + [{}]
-  stacks[0][lm.begin()] = initial_hypothesis
-  for i, stack in enumerate(stacks[:-1]):
-    for h in sorted(stack.itervalues(),key=lambda h: -h.logprob)[:opts.s]: # prune
-      for j in xrange(i+1,len(f)+1):
-        if f[i:j] in tm:
-          for phrase in tm[f[i:j]]:
-            logprob = h.logprob + phrase.logprob
-            lm_state = h.lm_state
-            for word in phrase.english.split():
-              (lm_state, word_logprob) = lm.score(lm_state, word)
-              logprob += word_logprob
-            logprob += lm.end(lm_state) if j == len(f) else 0.0
-            new_hypothesis = hypothesis(logprob, lm_state, h, phrase)
-            if lm_state not in stacks[j] or stacks[j][lm_state].logprob < logprob: # second case is recombination
-              stacks[j][lm_state] = new_hypothesis 
-  winner = max(stacks[-1].itervalues(), key=lambda h: h.logprob)
-  def extract_english(h): 
-    return "" if h.predecessor is None else "%s%s " % (extract_english(h.predecessor), h.phrase.english)
-  print extract_english(winner)
+search_stats = None
+new_stack = models.Stack
+if opts.stats:
+  search_stats = models.SearchStats()
+  (tm, lm) = (models.TimedTM(tm, search_stats), models.TimedLM(lm, search_stats))
+  new_stack = functools.partial(models.TimedStack, search_stats)
+
+def future_costs(f, spans):
+  """
+  Estimate, for every span f[i:j], the best log probability of translating
+  it on its own: the best way of splitting it into phrases, each scored by
+  its best translation (TM logprob plus LM logprob without any context).
+  The best split of f[i:j] is the best split of some f[i:k] followed by a
+  phrase f[k:j], so only the phrases ending at j are tried as last split
+  points, rather than every k.
+  """
+  n = len(f)
+  fc = [[float('-inf')] * (n+1) for _ in xrange(n+1)]
+  ending = [[] for _ in xrange(n+1)] # j -> [(k, logprob of the best phrase f[k:j])]
+  for i in xrange(n):
+    for (j, phrases) in spans[i]:
+      fc[i][j] = max(phrase.logprob + lm.score_phrase(lm.empty(), phrase.english)[1] for phrase in phrases)
+      ending[j].append((i, fc[i][j]))
+  for i in xrange(n):
+    row = fc[i]
+    for j in xrange(i+2, n+1):
+      for (k, logprob) in ending[j]:
+        if k > i and row[k] + logprob > row[j]:
+          row[j] = row[k] + logprob
+  return fc
+
+def first_uncovered(coverage):
+  "Position of the lowest 0 bit of coverage."
+  return (~coverage & (coverage+1)).bit_length() - 1
+
+def popcount(coverage):
+  return bin(coverage).count("1")
+
+def derivations(stacks, hyps):
+  """
+  Yield the derivations of the hypotheses in the last stack, best first,
+  as (logprob, english, tm_logprob).
+
+  Every hypothesis h that survived in a stack is a node of the search
+  graph, and h itself and the hypotheses merged into it by recombination
+  are its incoming arcs: each arc leads from its predecessor node and
+  adds its logprob minus the predecessor's. The k-best derivations of
+  each node are enumerated lazily (algorithm 3 of Huang and Chiang, 2005,
+  "Better k-best parsing"): a node keeps the derivations found so far and
+  a heap of candidates, one per arc, and the k+1st best of a node is
+  only computed when it is asked for, so that n-best lists cost little
+  more than the 1-best.
+  """
+  (logprobs, predecessors, phrases) = (hyps.logprob, hyps.predecessor, hyps.phrase)
+  found = {} # node -> list of (logprob, arc, rank of the predecessor's derivation)
+  candidates = {} # node -> (arcs, heap of (-logprob, arc index, rank))
+  pending = {} # node -> (arc index, rank) of its last derivation, whose successor is not in the heap yet
+  def start(node):
+    coverage = hyps.coverage[node]
+    arcs = [node] + stacks[popcount(coverage)].merged.get((hyps.lm_state[node], coverage, hyps.end[node]), [])
+    heap = [(-logprobs[arc], a, 0) for (a, arc) in enumerate(arcs)]
+    heapq.heapify(heap)
+    (found[node], candidates[node], pending[node]) = ([], (arcs, heap), None)
+  def known(node, k):
+    "Whether the k-th best derivation of node is found or known not to exist."
+    if predecessors[node] < 0:
+      return True
+    return node in found and (k < len(found[node]) or (not candidates[node][1] and pending[node] is None))
+  def lookup(node, k):
+    if predecessors[node] < 0:
+      return (0.0, None, None) if k == 0 else None
+    return found[node][k] if k < len(found[node]) else None
+  def kth(node, k):
+    """
+    The k-th best derivation of node, or None if it has fewer. Finding it
+    may need derivations of the predecessors, all the way back to the
+    initial hypothesis, so they are worked out with a stack of
+    (node, k) requests rather than by recursion.
+    """
+    work = [(node, k)]
+    while work:
+      (n, k) = work[-1]
+      if known(n, k):
+        work.pop()
+        continue
+      if n not in found:
+        start(n)
+      (arcs, heap) = candidates[n]
+      if pending[n] is not None:
+        # push the successor of the last derivation before popping the next
+        (a, rank) = pending[n]
+        arc = arcs[a]
+        if not known(predecessors[arc], rank+1):
+          work.append((predecessors[arc], rank+1))
+          continue
+        successor = lookup(predecessors[arc], rank+1)
+        if successor is not None:
+          heapq.heappush(heap, (-(successor[0] + logprobs[arc] - logprobs[predecessors[arc]]), a, rank+1))
+        pending[n] = None
+      elif heap:
+        (logprob, a, rank) = heapq.heappop(heap)
+        found[n].append((-logprob, arcs[a], rank))
+        pending[n] = (a, rank)
+    return lookup(node, k)
+  def describe(node, rank):
+    "The translation and TM logprob of the rank-th best derivation of node."
+    chain = []
+    while predecessors[node] >= 0:
+      if node not in found or rank >= len(found[node]):
+        kth(node, rank)
+      (_, arc, rank) = found[node][rank]
+      chain.append(phrases[arc])
+      node = predecessors[arc]
+    chain.reverse()
+    return (" ".join(phrase.english for phrase in chain), sum(phrase.logprob for phrase in chain))
+  # the final hypotheses are the arcs into a goal node, each adding 0
+  finals = stacks[-1].hypotheses()
+  heap = [(-logprobs[h], a, 0) for (a, h) in enumerate(finals)]
+  while heap:
+    (logprob, a, rank) = heapq.heappop(heap)
+    yield (-logprob,) + describe(finals[a], rank)
+    successor = kth(finals[a], rank+1)
+    if successor is not None:
+      heapq.heappush(heap, (-successor[0], a, rank+1))
 
+def lattice(n, stacks, hyps):
+  """
+  The search graph of sentence n as lines 'n ||| node ||| predecessor |||
+  i-j ||| english ||| logprob', one per arc: the phrase translating f[i:j]
+  into english leads from the predecessor node (0 is the initial one) to
+  the node, and the hypothesis it makes has the given logprob. Nodes
+  that translate the whole sentence then get a line 'n ||| node ||| end'.
+  """
+  (ids, lines) = ({}, [])
+  def node_id(h):
+    return ids.setdefault(h, len(ids))
+  for stack in stacks:
+    for (key, (_, h)) in sorted(stack.entries.iteritems(), key=lambda (key, entry): -entry[0]):
+      for arc in [h] + stack.merged.get(key, []):
+        predecessor = hyps.predecessor[arc]
+        if predecessor >= 0:
+          span = hyps.coverage[arc] ^ hyps.coverage[predecessor]
+          (i, j) = ((span & -span).bit_length() - 1, span.bit_length())
+          lines.append("%d ||| %d ||| %d ||| %d-%d ||| %s ||| %f\n" % (n, node_id(h), node_id(predecessor), i, j, hyps.phrase[arc].english, hyps.logprob[arc]))
+        else:
+          node_id(h)
+  lines.extend("%d ||| %d ||| end\n" % (n, node_id(h)) for h in stacks[-1].hypotheses())
+  return "".join(lines)
+
+def decode(n, f):
+  """
+  Translate the tuple of French words f, sentence n of the input. Return
+  the output for it (its best translation, or its n-best list), a log of
+  the search if opts.verbose, its search graph if opts.lattice, and its
+  search statistics if opts.stats.
+  """
+  if search_stats:
+    (start, lm_counters) = (time.time(), lm.counters())
+    search_stats.reset()
+  # Hypotheses in stacks[i] translate any i words of the input sentence,
+  # marked by the bits of the integer coverage. A hypothesis is an index
+  # into hyps, which holds its logprob, lm_state, coverage, end,
+  # predecessor (another index) and phrase, where end is the position
+  # after the last French word translated; the next phrase may start at
+  # most opts.d words away from it (so the default -d 0 is a monotone
+  # decoder). Hypotheses with the same LM state, coverage and end are
+  # recombined, and stacks are pruned on logprob plus the future cost
+  # estimate of the words left to translate, keeping the best opts.s
+  # within opts.beam of the best. A monotone decoder leaves the same
+  # words to translate for every hypothesis in a stack, so it skips the
+  # estimate, which would not change what is pruned.
+  full = (1 << len(f)) - 1
+  spans = models.span_index(tm, f, maxlen)
+  fc = future_costs(f, spans) if opts.d > 0 else None
+  # the options starting at i, with the bits of the words they cover
+  options = [[(j, (1 << j) - (1 << i), phrases) for (j, phrases) in starts] for (i, starts) in enumerate(spans)]
+  estimates = {}
+  def future_cost(coverage):
+    "Sum of the future costs of the uncovered spans of coverage."
+    if fc is None:
+      return 0.0
+    if coverage not in estimates:
+      (cost, i) = (0.0, first_uncovered(coverage))
+      while i < len(f):
+        j = i
+        while j < len(f) and not coverage >> j & 1:
+          j += 1
+        cost += fc[i][j]
+        i = first_uncovered(coverage | ((1 << j) - 1))
+      estimates[coverage] = cost
+    return estimates[coverage]
+  hyps = models.Hypotheses()
+  initial_hypothesis = hyps.add(0.0, lm.begin(), 0, 0, -1, None)
+  keep_merged = opts.nbest > 0 or opts.lattice is not None
+  stacks = [new_stack(opts.s, opts.beam, keep_merged) for _ in xrange(len(f)+1)]
+  stacks[0].add((lm.begin(), 0, 0), future_cost(0), initial_hypothesis)
+  for covered, stack in enumerate(stacks[:-1]):
+    for h in stack.hypotheses():
+      stack.expanded += 1
+      (h_logprob, h_lm_state, coverage, end) = (hyps.logprob[h], hyps.lm_state[h], hyps.coverage[h], hyps.end[h])
+      for i in xrange(max(0, end - opts.d), min(len(f), end + opts.d + 1)):
+        for (j, span, phrases) in options[i]:
+          if coverage & span: # f[i:j] overlaps what h translated, as do longer spans
+            break
+          new_coverage = coverage | span
+          if new_coverage != full and abs(first_uncovered(new_coverage) - j) > opts.d:
+            continue # the first untranslated word would be out of reach
+          (next_stack, future) = (stacks[covered + j-i], future_cost(new_coverage))
+          for phrase in phrases:
+            (lm_state, lm_logprob) = lm.score_phrase(h_lm_state, phrase.english)
+            logprob = h_logprob + phrase.logprob + lm_logprob
+            logprob += lm.end(lm_state) if new_coverage == full else 0.0
+            if next_stack.add((lm_state, new_coverage, j), logprob + future, len(hyps)):
+              hyps.add(logprob, lm_state, new_coverage, j, h, phrase)
+  winner = stacks[-1].hypotheses()[0]
+  phrases = hyps.phrases(winner)
+  output = "".join("%s " % phrase.english for phrase in phrases) + "\n"
+  if opts.nbest:
+    (output, seen) = ("", set())
+    for (logprob, english, tm_logprob) in derivations(stacks, hyps):
+      if english not in seen:
+        seen.add(english)
+        output += "%d ||| %s ||| %f %f\n" % (n, english, logprob - tm_logprob, tm_logprob)
+        if len(seen) == opts.nbest:
+          break
+
+  log = ""
   if opts.verbose:
-    def extract_tm_logprob(h):
-      return 0.0 if h.predecessor is None else h.phrase.logprob + extract_tm_logprob(h.predecessor)
-    tm_logprob = extract_tm_logprob(winner)
-    sys.stderr.write("LM = %f, TM = %f, Total = %f\n" % 
-      (winner.logprob - tm_logprob, tm_logprob, winner.logprob))
+    tm_logprob = sum(phrase.logprob for phrase in phrases)
+    log += "LM = %f, TM = %f, Total = %f\n" % (hyps.logprob[winner] - tm_logprob, tm_logprob, hyps.logprob[winner])
+    log += "Stacks: %d expanded, %d recombined, %d pruned (expanded/recombined/pruned per stack: %s)\n" % (
+      sum(stack.expanded for stack in stacks), sum(stack.recombined for stack in stacks), sum(stack.pruned for stack in stacks),
+      " ".join("%d/%d/%d" % (stack.expanded, stack.recombined, stack.pruned) for stack in stacks))
+  record = None
+  if search_stats:
+    (word_lookups, word_misses, phrase_lookups, phrase_misses) = [after - before for (after, before) in zip(lm.counters(), lm_counters)]
+    record = {"sentence": n, "words": len(f), "time": time.time() - start,
+              "tm_time": search_stats.tm_time, "lm_time": search_stats.lm_time, "stack_time": search_stats.stack_time,
+              "tm_lookups": search_stats.tm_lookups, "lm_calls": search_stats.lm_calls,
+              "lm_word_lookups": word_lookups, "lm_word_hits": word_lookups - word_misses,
+              "lm_phrase_lookups": phrase_lookups, "lm_phrase_hits": phrase_lookups - phrase_misses}
+    for counter in ("created", "recombined", "pruned", "expanded"):
+      record[counter] = sum(getattr(stack, counter) for stack in stacks)
+    record["stacks"] = [dict(created=stack.created, recombined=stack.recombined, pruned=stack.pruned, expanded=stack.expanded) for stack in stacks]
+  return (output, log, lattice(n, stacks, hyps) if opts.lattice else "", record)
+
+def decode_in_worker((n, f)):
+  "decode(n, f) in a worker process, also returning what it added to the LM cache counters."
+  before = lm.counters()
+  return decode(n, f) + (tuple(after - start for (after, start) in zip(lm.counters(), before)),)
+
+sys.stderr.write("Decoding %s...\n" % (opts.input,))
+if opts.workers > 1:
+  # tm and lm are loaded above, before the pool forks, so the workers
+  # share them copy-on-write. imap hands out one sentence at a time and
+  # returns the translations in input order.
+  import multiprocessing
+  pool = multiprocessing.Pool(opts.workers)
+  results = pool.imap(decode_in_worker, enumerate(french))
+else:
+  results = (decode(n, f) for (n, f) in enumerate(french))
+lattice_file = open(opts.lattice, "w") if opts.lattice else None
+stats_file = open(opts.stats, "w") if opts.stats else None
+totals = {"sentences": 0}
+for result in results:
+  (output, log, graph, record) = result[:4]
+  sys.stdout.write(output)
+  sys.stderr.write(log)
+  if lattice_file:
+    lattice_file.write(graph)
+  if stats_file:
+    stats_file.write(json.dumps(record, sort_keys=True) + "\n")
+    totals["sentences"] += 1
+    for (name, value) in record.iteritems():
+      if name not in ("sentence", "stacks"):
+        totals[name] = totals.get(name, 0) + value
+  if opts.workers > 1:
+    lm.add_counters(result[4])
+if opts.workers > 1:
+  pool.close()
+  pool.join()
+if lattice_file:
+  lattice_file.close()
+if stats_file:
+  stats_file.write(json.dumps(totals, sort_keys=True) + "\n")
+  stats_file.close()
+
+if opts.verbose:
+  sys.stderr.write("%s\n" % lm.stats())
@@ -1,7 +1,9 @@
 #!/usr/bin/env python
 # Simple translation model and language model data structures
-import sys
+import sys, os, mmap, struct, heapq, time
+from array import array
 from collections import namedtuple
+import numpy as np
 
 # A translation model is a dictionary where keys are tuples of French words
 # and values are lists of (english, logprob) named tuples. For instance,
@@ -22,6 +24,183 @@ def TM(filename, k):
     del tm[f][k:] 
   return tm
 
+# compile-tm.py writes the translation model to a binary file that is
+# mmap'ed instead of parsed. French words are integer ids 1..V, and each
+# French phrase is found through an open addressing table (double
+# hashing, like ArrayLM) on a hash of its ids, then checked against the
+# ids stored for it. The translations of each phrase are stored sorted
+# best first, as TM sorts them, so the top k are simply the first k. The
+# file is laid out as
+#
+#   header | french words | english phrases | logprob[ncands] |
+#   table[size] | f_offsets[nkeys+1] | f_ids[...] | cand_offsets[nkeys+1] | e_offsets[ncands+1]
+#
+# where the french words are one per line, the english phrases are
+# concatenated, and phrase n has ids f_ids[f_offsets[n]:f_offsets[n+1]]
+# and translations cand_offsets[n] up to cand_offsets[n+1]. The header
+# records the largest k kept by compile-tm.py (0 if it kept them all).
+TM_MAGIC = 'TMBIN001'
+tm_header = struct.Struct('<8siiiii') # magic, nkeys, ncands, size, maxlen, k
+_P = 2147483647 # phrase hashes are taken mod this prime, so they stay small ints
+
+def compiled_tm_name(filename):
+  return filename + '.bin'
+
+def is_compiled_tm(filename):
+  with open(filename, 'rb') as f:
+    return f.read(len(TM_MAGIC)) == TM_MAGIC
+
+def compile_tm(filename, k=0):
+  "Return the bytes of a compiled translation model with the top k (or all, with k=0) translations of each phrase."
+  tm = TM(filename, k or sys.maxint)
+  words = sorted(set(word for f in tm for word in f))
+  codes = dict((word, i+1) for (i, word) in enumerate(words))
+  keys = sorted(tm)
+  (f_offsets, f_ids, cand_offsets, e_offsets, logprobs, english) = (array('i', [0]), array('i'), array('i', [0]), array('i', [0]), array('d'), [])
+  for f in keys:
+    f_ids.extend(codes[word] for word in f)
+    f_offsets.append(len(f_ids))
+    for phrase in tm[f]:
+      english.append(phrase.english)
+      e_offsets.append(e_offsets[-1] + len(phrase.english))
+      logprobs.append(phrase.logprob)
+    cand_offsets.append(len(logprobs))
+  size = _prime_above(2*len(keys)+1)
+  table = array('i', [0]) * size
+  for (n, f) in enumerate(keys):
+    h = _phrase_hash([codes[word] for word in f], len(words)+1)
+    (slot, step) = (h % size, 1 + h % (size-2))
+    while table[slot]:
+      slot = (slot + step) % size
+    table[slot] = n+1
+  def padded(s):
+    return struct.pack('<i', len(s)) + s + '\0' * (-(len(s)+4) % 8)
+  return ''.join([tm_header.pack(TM_MAGIC, len(keys), len(logprobs), size, max([len(f) for f in keys] or [0]), k),
+                  padded('\n'.join(words)), padded(''.join(english)), logprobs.tostring(),
+                  table.tostring(), f_offsets.tostring(), f_ids.tostring(), cand_offsets.tostring(), e_offsets.tostring()])
+
+def _phrase_hash(codes, base):
+  h = 0
+  for c in codes:
+    h = (h * base + c) % _P
+  return h
+
+class MappedTM:
+  """
+  A translation model read lazily from a file compiled by compile-tm.py.
+  It acts as the dict that TM returns: tm[f] is the list of the top k
+  phrase(english, logprob) translations of the tuple of French words f.
+  Lists are built on first access and kept, and entries assigned to the
+  tm (unknown words, say) are kept in memory next to the file.
+  """
+  def __init__(self, filename, k):
+    with open(filename, 'rb') as f:
+      self.buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    (magic, self.nkeys, ncands, self.size, self.maxlen, self.compiled_k) = tm_header.unpack_from(self.buf, 0)
+    if magic != TM_MAGIC:
+      raise ValueError("%s is not a compiled translation model (bad magic %r)" % (filename, magic))
+    self.k = k
+    offset = tm_header.size
+    sections = []
+    for _ in xrange(2):
+      (nbytes,) = struct.unpack_from('<i', self.buf, offset)
+      sections.append(self.buf[offset+4:offset+4+nbytes])
+      offset += 4 + nbytes + (-(nbytes+4) % 8)
+    (words, self.english) = sections
+    words = words.split('\n') if words else []
+    self.codes = dict((word, i+1) for (i, word) in enumerate(words))
+    self.base = len(words)+1
+    def section(dtype, count):
+      data = np.frombuffer(self.buf, dtype=dtype, count=count, offset=section.offset)
+      section.offset += data.nbytes
+      return data
+    section.offset = offset
+    self.logprobs = section(np.float64, ncands)
+    self.table = section(np.int32, self.size)
+    self.f_offsets = section(np.int32, self.nkeys+1)
+    self.f_ids = section(np.int32, int(self.f_offsets[-1]))
+    self.cand_offsets = section(np.int32, self.nkeys+1)
+    self.e_offsets = section(np.int32, ncands+1)
+    self.entries = {} # f -> list of phrases, or None if f is not in the tm
+
+  def _find(self, f):
+    "Index of the French phrase f in the file, or -1."
+    codes = [self.codes.get(word) for word in f]
+    if None in codes or not codes:
+      return -1
+    h = _phrase_hash(codes, self.base)
+    (slot, step) = (h % self.size, 1 + h % (self.size-2))
+    while True:
+      n = int(self.table[slot]) - 1
+      if n < 0:
+        return -1
+      if self.f_ids[self.f_offsets[n]:self.f_offsets[n+1]].tolist() == codes:
+        return n
+      slot = (slot + step) % self.size
+
+  def get(self, f, default=None):
+    if f not in self.entries:
+      n = self._find(f)
+      if n < 0:
+        self.entries[f] = None
+      else:
+        (start, end) = (int(self.cand_offsets[n]), int(self.cand_offsets[n+1]))
+        end = min(end, start + self.k)
+        e = self.e_offsets[start:end+1].tolist()
+        self.entries[f] = [phrase(self.english[e[i]:e[i+1]], logprob) for (i, logprob) in enumerate(self.logprobs[start:end].tolist())]
+    entry = self.entries[f]
+    return default if entry is None else entry
+
+  def __contains__(self, f):
+    return self.get(f) is not None
+
+  def __getitem__(self, f):
+    entry = self.get(f)
+    if entry is None:
+      raise KeyError(f)
+    return entry
+
+  def __setitem__(self, f, phrases):
+    self.entries[f] = phrases
+
+def load_tm(filename, k):
+  """
+  Return a MappedTM if filename is a compiled translation model or has an
+  up to date compiled copy that kept at least the top k translations, and
+  read it with TM otherwise.
+  """
+  if is_compiled_tm(filename):
+    return MappedTM(filename, k)
+  compiled = compiled_tm_name(filename)
+  if os.path.exists(compiled) and os.path.getmtime(compiled) >= os.path.getmtime(filename):
+    tm = MappedTM(compiled, k)
+    if tm.compiled_k == 0 or k <= tm.compiled_k:
+      sys.stderr.write("Reading translation model from %s...\n" % (compiled,))
+      return tm
+  return TM(filename, k)
+
+# A span index lists, for each start position i of a French sentence f,
+# the spans f[i:j] that the translation model can translate, as
+# (j, phrases) pairs by increasing j. Building it once per sentence looks
+# each span up once, and only spans up to max_phrase_length(tm) words
+# long, instead of slicing and hashing f[i:j] in every inner loop.
+def max_phrase_length(tm):
+  "The number of words in the longest French phrase of tm."
+  if isinstance(tm, MappedTM):
+    return max(tm.maxlen, 1)
+  return max(len(f) for f in tm) if tm else 1
+
+def span_index(tm, f, maxlen):
+  index = []
+  for i in xrange(len(f)):
+    options = []
+    for j in xrange(i+1, min(len(f), i+maxlen)+1):
+      phrases = tm.get(f[i:j])
+      if phrases is not None:
+        options.append((j, phrases))
+    index.append(options)
+  return index
+
 # # A language model scores sequences of English words, and must account
 # # for both beginning and end of each sequence. Example API usage:
 # lm = models.LM(filename)
@@ -32,6 +211,8 @@ def TM(filename, k):
 #   (lm_state, word_logprob) = lm.score(lm_state, word)
 #   logprob += word_logprob
 # logprob += lm.end(lm_state) # transition to </s>, can also use lm.score(lm_state, "</s>")[1]
+# lm.empty() is the state with no context at all, which is useful to
+# estimate the score of a phrase wherever it ends up in the sentence.
 ngram_stats = namedtuple("ngram_stats", "logprob, backoff")
 class LM:
   def __init__(self, filename):
@@ -46,6 +227,9 @@ class LM:
   def begin(self):
     return ("<s>",)
 
+  def empty(self):
+    return ()
+
   def score(self, state, word):
     ngram = state + (word,)
     score = 0.0
@@ -59,3 +243,434 @@ class LM:
     
   def end(self, state):
     return self.score(state, "</s>")[1]
+
+  def words(self, state):
+    return state
+
+# ArrayLM reads the same file as LM and has the same API, but it keeps the
+# model in flat arrays instead of a dict of tuples. Words are integer ids,
+# and an n-gram of ids w1..wn is packed into the integer key
+#   (w1+1)*B^(n-1) + ... + (wn+1)    where B = len(vocab)+1,
+# so that appending a word is key*B + w+1, dropping the first word is
+# key % B^(n-1) and dropping the last is key // B. Keys of different
+# orders never collide (an n-gram key is in [B^(n-1), B^n)), so the
+# n-grams of every order share one open addressing hash table of keys,
+# with float32 logprob and backoff arrays alongside. States are the keys
+# of the last two words (0 is the empty state), so they are plain ints
+# that the decoder can hash cheaply; lm.words(state) gives back the words.
+# Scores are rounded to float32, so ties between nearly equally good
+# translations may be broken differently than with LM.
+def _prime_above(n):
+  "Smallest prime >= n."
+  n = max(n, 2)
+  while any(n % d == 0 for d in xrange(2, int(n**0.5)+1)):
+    n += 1
+  return n
+
+class ArrayLM:
+  def __init__(self, filename):
+    sys.stderr.write("Reading language model from %s...\n" % (filename,))
+    vocab = {}
+    ids = {} # n -> flat array of the word ids of the n-grams of order n
+    stats = {} # n -> (logprobs, backoffs)
+    for line in open(filename):
+      entry = line.strip().split("\t")
+      if len(entry) > 1 and entry[0] != "ngram":
+        ngram = entry[1].split()
+        n = len(ngram)
+        if n not in ids:
+          (ids[n], stats[n]) = (array('i'), (array('d'), array('d')))
+        ids[n].extend(vocab.setdefault(word, len(vocab)) for word in ngram)
+        stats[n][0].append(float(entry[0]))
+        stats[n][1].append(float(entry[2] if len(entry)==3 else 0.0))
+    if "<unk>" not in vocab:
+      raise ValueError("%s has no <unk> unigram" % (filename,))
+    self.codes = dict((word, i+1) for (word, i) in vocab.iteritems()) # word -> id+1, as it appears in keys
+    self.vocab = sorted(vocab, key=vocab.get)
+    self.base = len(vocab)+1
+    order = max(max(ids), 2)
+    if self.base ** order >= 1<<63:
+      raise ValueError("%s: a vocabulary of %d words is too large to pack %d-grams into 64 bits" % (filename, len(vocab), order))
+    keys = []
+    for (n, flat) in sorted(ids.iteritems()):
+      words = np.frombuffer(flat, dtype=np.int32).reshape(-1, n).astype(np.int64) + 1
+      keys.append(np.zeros(len(words), dtype=np.int64))
+      for i in xrange(n):
+        keys[-1] = keys[-1] * self.base + words[:, i]
+    (logprobs, backoffs) = ([np.frombuffer(stats[n][0]) for n in sorted(stats)], [np.frombuffer(stats[n][1]) for n in sorted(stats)])
+    self._build(np.concatenate(keys), np.concatenate(logprobs), np.concatenate(backoffs))
+    self.unk = self.logprobs[self._find(self.codes["<unk>"])]
+    self.state_mod = self.base ** 2 # states keep the last two words, like LM
+
+  def _build(self, keys, logprobs, backoffs):
+    """
+    Fill the open addressing table with distinct keys. Key k goes in the
+    first free slot of k, k+step, k+2*step, ... (mod size), where step is
+    1 + k % (size-2). The keys of the n-grams that share a context are
+    consecutive, so probing by a step that depends on the key (double
+    hashing) is what keeps them from piling up in long runs of full slots.
+    """
+    self.size = _prime_above(2*len(keys)+1) # at most half full; a prime size spreads out the structured keys
+    slots = keys % self.size
+    steps = 1 + keys % (self.size-2)
+    table = np.zeros(self.size, dtype=np.int64) # 0 is never a key
+    position = np.zeros(self.size, dtype=np.int64)
+    pending = np.arange(len(keys))
+    while len(pending):
+      # the first pending key that wants each empty slot gets it, and the
+      # others move on to the next slot
+      free = np.flatnonzero(table[slots[pending]] == 0)
+      (taken, first) = np.unique(slots[pending[free]], return_index=True)
+      (table[taken], position[taken]) = (keys[pending[free[first]]], pending[free[first]])
+      placed = np.zeros(len(pending), dtype=bool)
+      placed[free[first]] = True
+      pending = pending[~placed]
+      slots[pending] = (slots[pending] + steps[pending]) % self.size
+    occupied = table != 0
+    (lp, bo) = (np.zeros(self.size, dtype=np.float32), np.zeros(self.size, dtype=np.float32))
+    lp[occupied] = logprobs[position[occupied]]
+    bo[occupied] = backoffs[position[occupied]]
+    # indexing an array.array gives python ints and floats, which is much
+    # faster than indexing numpy arrays one element at a time
+    (self.keys, self.logprobs, self.backoffs) = (array('l', table.tobytes()), array('f', lp.tobytes()), array('f', bo.tobytes()))
+
+  def _find(self, key):
+    "Slot of the n-gram key in the table, or -1."
+    slot = key % self.size
+    while True:
+      found = self.keys[slot]
+      if found == key:
+        return slot
+      if found == 0:
+        return -1
+      slot = (slot + 1 + key % (self.size-2)) % self.size
+
+  def begin(self):
+    return self.codes["<s>"]
+
+  def empty(self):
+    return 0
+
+  def score(self, state, word):
+    keys = self.keys
+    size = self.size
+    code = self.codes.get(word)
+    score = 0.0
+    while True:
+      if code is not None:
+        key = state * self.base + code
+        slot = key % size # _find, inlined
+        found = keys[slot]
+        while found != key and found != 0:
+          slot = (slot + 1 + key % (size-2)) % size
+          found = keys[slot]
+        if found:
+          return (key % self.state_mod, score + self.logprobs[slot])
+      if state == 0:
+        return (0, score + self.unk)
+      # backoff
+      slot = self._find(state)
+      if slot >= 0:
+        score += self.backoffs[slot]
+      first = self.base # B^(len(state)-1), which drops the first word of state
+      while state >= first * self.base:
+        first *= self.base
+      state = state % first if state >= first else 0
+
+  def end(self, state):
+    return self.score(state, "</s>")[1]
+
+  def words(self, state):
+    words = []
+    while state:
+      words.append(self.vocab[state % self.base - 1])
+      state //= self.base
+    return tuple(reversed(words))
+
+# LMCache wraps a language model and memoizes score() on (state, word) and
+# whole phrases on (state, english), since the decoder scores the same
+# phrases from the same states over and over. Each table is emptied when
+# it reaches size entries, which keeps memory bounded without the cost of
+# LRU bookkeeping on every call. Only lookups and misses are counted (hits
+# are the difference), to keep the bookkeeping off the hit path; stats()
+# reports the hit rates.
+class LMCache:
+  def __init__(self, lm, size=1000000):
+    (self.lm, self.size) = (lm, size)
+    (self.word_table, self.phrase_table) = ({}, {})
+    (self.lookups, self.misses, self.phrase_lookups, self.phrase_misses) = (0, 0, 0, 0)
+
+  def begin(self):
+    return self.lm.begin()
+
+  def empty(self):
+    return self.lm.empty()
+
+  def score(self, state, word):
+    self.lookups += 1
+    result = self.word_table.get((state, word))
+    if result is None:
+      self.misses += 1
+      if len(self.word_table) >= self.size:
+        self.word_table.clear()
+      result = self.word_table[state, word] = self.lm.score(state, word)
+    return result
+
+  def end(self, state):
+    return self.score(state, "</s>")[1]
+
+  def score_phrase(self, state, english):
+    "Return the state after the words of the string english, and their total log probability."
+    if " " not in english: # a single word is already memoized by score()
+      return self.score(state, english)
+    self.phrase_lookups += 1
+    result = self.phrase_table.get((state, english))
+    if result is not None:
+      return result
+    self.phrase_misses += 1
+    if len(self.phrase_table) >= self.size:
+      self.phrase_table.clear()
+    if len(self.word_table) >= self.size:
+      self.word_table.clear()
+    (word_table, start, logprob) = (self.word_table, state, 0.0)
+    words = english.split()
+    self.lookups += len(words)
+    for word in words:
+      result = word_table.get((state, word))
+      if result is None:
+        self.misses += 1
+        result = word_table[state, word] = self.lm.score(state, word)
+      (state, word_logprob) = result
+      logprob += word_logprob
+    result = self.phrase_table[start, english] = (state, logprob)
+    return result
+
+  def words(self, state):
+    return self.lm.words(state)
+
+  def counters(self):
+    return (self.lookups, self.misses, self.phrase_lookups, self.phrase_misses)
+
+  def add_counters(self, counters):
+    "Add counters collected by another process (a copy of this cache) to ours."
+    (self.lookups, self.misses, self.phrase_lookups, self.phrase_misses) = [mine + theirs for (mine, theirs) in zip(self.counters(), counters)]
+
+  def stats(self):
+    def rate(lookups, misses):
+      return 100.0 * (lookups - misses) / lookups if lookups else 0.0
+    return "LM cache: %d word lookups (%.1f%% hits), %d phrase lookups (%.1f%% hits)" % (
+      self.lookups, rate(self.lookups, self.misses), self.phrase_lookups, rate(self.phrase_lookups, self.phrase_misses))
+
+# Hypotheses holds the hypotheses of one search column by column, and a
+# hypothesis is its index, so that a hypothesis costs a few array slots
+# instead of an object, and its predecessor is an index too (-1 for the
+# initial hypothesis). Backtraces are loops over predecessor indices, so
+# they work on sentences of any length. Most new hypotheses are pruned
+# or recombined right away, so the decoder offers a stack the index a
+# hypothesis would get, len(hyps), and only adds it if the stack kept it.
+class Hypotheses:
+  def __init__(self):
+    self.logprob = array('d')
+    self.lm_state = [] # LM states need not be ints
+    self.coverage = [] # nor coverage bitmaps of long sentences
+    self.end = array('i')
+    self.predecessor = array('i')
+    self.phrase = []
+
+  def __len__(self):
+    return len(self.end)
+
+  def add(self, logprob, lm_state, coverage, end, predecessor, phrase):
+    self.logprob.append(logprob)
+    self.lm_state.append(lm_state)
+    self.coverage.append(coverage)
+    self.end.append(end)
+    self.predecessor.append(predecessor)
+    self.phrase.append(phrase)
+    return len(self.end) - 1
+
+  def phrases(self, h):
+    "The phrases of the translation that ends in hypothesis h, first to last."
+    phrases = []
+    while self.predecessor[h] >= 0:
+      phrases.append(self.phrase[h])
+      h = self.predecessor[h]
+    phrases.reverse()
+    return phrases
+
+# A Stack holds the hypotheses of one stack of the decoder, keyed by what
+# makes them recombinable, and prunes them as they are added instead of
+# sorting them all at the end. Once the stack is full, a min-heap of
+# (score, key) finds the worst hypothesis, so at most size of them are
+# kept (histogram pruning), and with a beam only those scoring within
+# beam of the best one survive (threshold pruning). Hypotheses that are
+# replaced or evicted are left in the heap and skipped when they come up.
+# The counters record how many hypotheses were created (added), pruned,
+# recombined and (by the decoder) expanded. With keep_merged, the hypotheses that lose
+# a recombination are kept in merged[key], so that the decoder can find
+# other derivations than the best one (for n-best lists).
+class Stack:
+  def __init__(self, size, beam=float('inf'), keep_merged=False):
+    (self.size, self.beam) = (size, beam)
+    self.entries = {} # key -> (score, hypothesis)
+    self.merged = {} if keep_merged else None
+    self.heap = None # built when the stack fills up
+    self.best = float('-inf')
+    self.survivors = None # what hypotheses() returns, until the next add
+    self.beam_pruned = 0 # entries that hypotheses() found out of the beam
+    (self.created, self.pruned, self.recombined, self.expanded) = (0, 0, 0, 0)
+
+  def __len__(self):
+    return len(self.entries)
+
+  def _worst(self):
+    "Score of the worst live hypothesis, dropping stale heap entries on the way."
+    heap = self.heap
+    while heap:
+      (score, key) = heap[0]
+      entry = self.entries.get(key)
+      if entry is not None and entry[0] == score:
+        return score
+      heapq.heappop(heap)
+    return float('-inf')
+
+  def add(self, key, score, hypothesis):
+    """
+    Add a hypothesis ranked by score, unless it is pruned or a hypothesis
+    with the same key scores at least as well (then it is only kept in
+    merged, with keep_merged). Return whether the hypothesis was kept.
+    """
+    self.created += 1
+    self.survivors = None
+    if score < self.best - self.beam:
+      self.pruned += 1
+      return False
+    if score > self.best:
+      self.best = score
+    entries = self.entries
+    entry = entries.get(key)
+    if entry is not None:
+      self.recombined += 1
+      if entry[0] >= score:
+        if self.merged is None:
+          return False
+        self.merged.setdefault(key, []).append(hypothesis)
+        return True
+      if self.merged is not None:
+        self.merged.setdefault(key, []).append(entry[1])
+      entries[key] = (score, hypothesis)
+      if self.heap is not None:
+        heapq.heappush(self.heap, (score, key))
+    elif self.heap is None:
+      entries[key] = (score, hypothesis)
+      if len(entries) >= self.size:
+        self.heap = [(entry[0], key) for (key, entry) in entries.iteritems()]
+        heapq.heapify(self.heap)
+    elif score <= self._worst():
+      self.pruned += 1
+      return False
+    else:
+      # evict the worst hypothesis to make room
+      (worst, worst_key) = heapq.heappop(self.heap)
+      del entries[worst_key]
+      if self.merged is not None:
+        self.merged.pop(worst_key, None)
+      self.pruned += 1
+      entries[key] = (score, hypothesis)
+      heapq.heappush(self.heap, (score, key))
+    return True
+
+  def hypotheses(self):
+    """
+    The hypotheses that survived pruning, best first. The beam is applied
+    once, and the entries it drops are counted as pruned once, however
+    often this is called.
+    """
+    if self.survivors is None:
+      survivors = [entry for entry in self.entries.itervalues() if entry[0] >= self.best - self.beam]
+      beam_pruned = len(self.entries) - len(survivors)
+      self.pruned += beam_pruned - self.beam_pruned
+      self.beam_pruned = beam_pruned
+      survivors.sort(key=lambda entry: -entry[0])
+      self.survivors = [hypothesis for (_, hypothesis) in survivors]
+    return self.survivors
+
+# The decoder's --stats instrumentation. SearchStats holds the time spent
+# in TM lookups, LM scoring and stack management, and the number of TM
+# lookups and LM calls, since the last reset(). TimedTM, TimedLM and
+# TimedStack stand in for a TM, an LMCache and a Stack and add to it, so
+# that the decoder pays for the clock only when it is asked to.
+class SearchStats:
+  def __init__(self):
+    self.reset()
+
+  def reset(self):
+    (self.tm_time, self.lm_time, self.stack_time) = (0.0, 0.0, 0.0)
+    (self.tm_lookups, self.lm_calls) = (0, 0)
+
+class TimedTM:
+  def __init__(self, tm, stats):
+    (self.tm, self.stats) = (tm, stats)
+
+  def __contains__(self, f):
+    start = time.time()
+    found = f in self.tm
+    self.stats.tm_time += time.time() - start
+    self.stats.tm_lookups += 1
+    return found
+
+  def get(self, f, default=None):
+    start = time.time()
+    phrases = self.tm.get(f, default)
+    self.stats.tm_time += time.time() - start
+    self.stats.tm_lookups += 1
+    return phrases
+
+  def __getitem__(self, f):
+    start = time.time()
+    phrases = self.tm[f]
+    self.stats.tm_time += time.time() - start
+    return phrases
+
+  def __setitem__(self, f, phrases):
+    self.tm[f] = phrases
+
+class TimedLM:
+  def __init__(self, lm, stats):
+    (self.lm, self.stats) = (lm, stats)
+
+  def _timed(self, method, *args):
+    start = time.time()
+    result = method(*args)
+    self.stats.lm_time += time.time() - start
+    self.stats.lm_calls += 1
+    return result
+
+  def score(self, state, word):
+    return self._timed(self.lm.score, state, word)
+
+  def score_phrase(self, state, english):
+    return self._timed(self.lm.score_phrase, state, english)
+
+  def end(self, state):
+    return self._timed(self.lm.end, state)
+
+  def __getattr__(self, name): # begin, empty, words, counters, ...
+    return getattr(self.lm, name)
+
+class TimedStack(Stack):
+  def __init__(self, stats, *args):
+    Stack.__init__(self, *args)
+    self.stats = stats
+
+  def add(self, key, score, hypothesis):
+    start = time.time()
+    kept = Stack.add(self, key, score, hypothesis)
+    self.stats.stack_time += time.time() - start
+    return kept
+
+  def hypotheses(self):
+    start = time.time()
+    hypotheses = Stack.hypotheses(self)
+    self.stats.stack_time += time.time() - start
+    return hypotheses
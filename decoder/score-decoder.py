@@ -4,44 +4,63 @@ import sys
 import models
 import math
 import logging
+import numpy as np
 
 # Some utility functions:
+# A coverage bitmap is an integer whose bit i is on if French word i is covered.
 def bitmap(sequence):
   """ Generate a coverage bitmap for a sequence of indexes """
-  return reduce(lambda x,y: x|y, map(lambda i: long('1'+'0'*i,2), sequence), 0)
+  b = 0
+  for i in sequence:
+    b |= 1 << i
+  return b
+
+def span_masks(n):
+  """ Precompute masks[i][j] = bitmap(range(i,j)) for 0 <= i <= j <= n """
+  return [[(1 << j) - (1 << i) if i <= j else 0 for j in xrange(n+1)] for i in xrange(n+1)]
 
 def bitmap2str(b, n, on='o', off='.'):
   """ Generate a length-n string representation of bitmap b """
-  return '' if n==0 else (on if b&1==1 else off) + bitmap2str(b>>1, n-1, on, off)
+  return ''.join(on if b >> i & 1 else off for i in xrange(n))
 
 def onbits(b):
   """ Count number of on bits in a bitmap """
-  return 0 if b==0 else (1 if b&1==1 else 0) + onbits(b>>1)
+  return bin(b).count('1')
 
 def prefix1bits(b):
   """ Count number of bits encountered before first 0 """
-  return 0 if b&1==0 else 1+prefix1bits(b>>1)
+  return (~b & (b+1)).bit_length() - 1
 
 def last1bit(b):
   """ Return index of highest order bit that is on """
-  return 0 if b==0 else 1+last1bit(b>>1)
+  return b.bit_length()
 
 def logadd10(x,y):
   """ Addition in logspace (base 10): if x=log(a) and y=log(b), returns log(a+b) """
   return x + math.log10(1 + pow(10,y-x))
 
+def logadd10_by_key(keys, logprobs):
+  """ Vectorized logadd10 of the logprobs that share a key: returns the
+  distinct keys (sorted) and the log of the sum for each of them """
+  keys, group = np.unique(keys, return_inverse=True)
+  top = np.full(len(keys), -np.inf)
+  np.maximum.at(top, group, logprobs)
+  sums = np.bincount(group, weights=np.power(10.0, logprobs - top[group]), minlength=len(keys))
+  return keys, top + np.log10(sums)
+
 optparser = optparse.OptionParser()
 optparser.add_option("-i", "--input", dest="input", default="data/input", help="File containing sentences to translate (default=data/input)")
 optparser.add_option("-t", "--translation-model", dest="tm", default="data/tm", help="File containing translation model (default=data/tm)")
 optparser.add_option("-l", "--language-model", dest="lm", default="data/lm", help="File containing ARPA-format language model (default=data/lm)")
 optparser.add_option("-v", "--verbosity", dest="verbosity", default=1, type="int", help="Verbosity level, 0-3 (default=1)")
+optparser.add_option("-w", "--workers", dest="workers", default=1, type="int", help="Number of worker processes scoring sentence pairs in parallel (default=1)")
 optparser.add_option("-o", "--logfile", dest="logfile", default=None, help="filename for logging output")
 opts = optparser.parse_args()[0]
 
 if opts.logfile:
     logging.basicConfig(filename=opts.logfile, filemode='w', level=logging.INFO)
 
-tm = models.TM(opts.tm,sys.maxint)
+tm = models.load_tm(opts.tm, sys.maxint)
 lm = models.LM(opts.lm)
 french = [tuple(line.strip().split()) for line in open(opts.input).readlines()]
 english = [tuple(line.strip().split()) for line in sys.stdin]
@@ -50,6 +69,7 @@ english = [tuple(line.strip().split()) for line in sys.stdin]
 for word in set(sum(french,())):
   if (word,) not in tm:
     tm[(word,)] = [models.phrase(word, 0.0)]
+maxlen = models.max_phrase_length(tm)
 
 def maybe_write(s, verbosity):
   if opts.logfile:
@@ -58,70 +78,128 @@ def maybe_write(s, verbosity):
     sys.stdout.write(s)
     sys.stdout.flush()
 
-maybe_write("Aligning...\n",0)
-maybe_write("NOTE: TM logprobs may be positive since they do not include segmentation\n",0)
-total_logprob = 0.0
-unaligned_sentences = 0
-for sent_num, (f, e) in enumerate(zip(french, english)):
-  maybe_write("===========================================================\n",1)
-  maybe_write("SENTENCE PAIR:\n%s\n%s\n" % (" ".join(f), " ".join(e)),0)
-
-  maybe_write("\nLANGUAGE MODEL SCORES:\n",1)
+def score(sent_num, f, e):
+  """
+  Score the French sentence f and its translation e, sentence sent_num of
+  the input. Returns the LM logprob, the TM logprob summed over all
+  alignments (None if there is none), and what maybe_write should write
+  for it, as (s, verbosity) pairs (verbosity None for errors, which are
+  always written to stdout).
+  """
+  output = []
+  def write(s, verbosity):
+    if verbosity is None or opts.logfile or opts.verbosity > verbosity:
+      output.append((s, verbosity))
+  write("===========================================================\n",1)
+  write("SENTENCE PAIR:\n%s\n%s\n" % (" ".join(f), " ".join(e)),0)
+
+  write("\nLANGUAGE MODEL SCORES:\n",1)
   lm_state = lm.begin()
   lm_logprob = 0.0
   for word in e + ("</s>",):
-    maybe_write("%s: " % " ".join(lm_state + (word,)),1)
+    write("%s: " % " ".join(lm.words(lm_state) + (word,)),1)
     (lm_state, word_logprob) = lm.score(lm_state, word)
     lm_logprob += word_logprob
-    maybe_write("%f\n" % (word_logprob,),1)
-  maybe_write("TOTAL LM LOGPROB: %f\n" % lm_logprob,0)
-  total_logprob += lm_logprob
+    write("%f\n" % (word_logprob,),1)
+  write("TOTAL LM LOGPROB: %f\n" % lm_logprob,0)
   
-  maybe_write("\nALL POSSIBLE PHRASE-TO-PHRASE ALIGNMENTS:\n",1)
+  write("\nALL POSSIBLE PHRASE-TO-PHRASE ALIGNMENTS:\n",1)
   alignments = [[] for _ in e]
-  for fi in xrange(len(f)):
-    for fj in xrange(fi+1,len(f)+1):
-      if f[fi:fj] in tm:
-        for phrase in tm[f[fi:fj]]:
-          ephrase = tuple(phrase.english.split())
-          for ei in xrange(len(e)+1-len(ephrase)):
-            ej = ei+len(ephrase)
-            if ephrase == e[ei:ej]:
-              maybe_write("%s ||| %d, %d : %d, %d ||| %s ||| %f\n" % 
-                (" ".join(f[fi:fj]), fi, fj, ei, ej, " ".join(ephrase), phrase.logprob),1)
-              alignments[ei].append((ej, phrase.logprob, fi, fj))
+  for fi, spans in enumerate(models.span_index(tm, f, maxlen)):
+    for fj, phrases in spans:
+      for phrase in phrases:
+        ephrase = tuple(phrase.english.split())
+        for ei in xrange(len(e)+1-len(ephrase)):
+          ej = ei+len(ephrase)
+          if ephrase == e[ei:ej]:
+            write("%s ||| %d, %d : %d, %d ||| %s ||| %f\n" % 
+              (" ".join(f[fi:fj]), fi, fj, ei, ej, " ".join(ephrase), phrase.logprob),1)
+            alignments[ei].append((ej, phrase.logprob, fi, fj))
 
   # Compute sum of probability of all possible alignments by dynamic programming.
-  # To do this, recursively compute the sum over all possible alignments for each
-  # each pair of English prefix (indexed by ei) and French coverage (indexed by 
-  # bitmap v), working upwards from the base case (ei=0, v=0) [i.e. forward chaining]. 
-  # The final sum is the one obtained for the pair (ei=len(e), v=range(len(f))
-  maybe_write("\nDYNAMIC PROGRAMMING SUM OVER ALIGNMENTS\n",2)
-  chart = [{} for _ in e] + [{}]
-  chart[0][0] = 0.0
-  for ei, sums in enumerate(chart[:-1]):
-    for v in sums:
-      for ej, logprob, fi, fj in alignments[ei]:
-        if bitmap(range(fi,fj)) & v == 0:
-          new_v = bitmap(range(fi,fj)) | v
-          maybe_write("(%d, %s): %f + (%d, %d, %s): %f -> (%d, %s): %f\n" % 
-            (ei, bitmap2str(v,len(f)), sums[v], 
-             ei, ej, bitmap2str(bitmap(range(fi,fj)),len(f)), logprob, 
-             ej, bitmap2str(new_v,len(f)), sums[v]+logprob), 2)
-          if new_v in chart[ej]:
-            chart[ej][new_v] = logadd10(chart[ej][new_v], sums[v]+logprob)
-          else:
-            chart[ej][new_v] = sums[v]+logprob
-    maybe_write(".",0)
-    maybe_write("\n",2)
-  goal = bitmap(range(len(f)))
-  if goal in chart[len(e)]:
-    maybe_write("\nTOTAL TM LOGPROB: %f\n" % chart[len(e)][goal],0)
-    total_logprob += chart[len(e)][goal]
+  # To do this, compute the sum over all possible alignments for each pair of
+  # English prefix (indexed by ei) and French coverage (indexed by bitmap v),
+  # working upwards from the base case (ei=0, v=0) [i.e. forward chaining].
+  # The final sum is the one obtained for the pair (ei=len(e), v=range(len(f)).
+  # chart[ei] holds the bitmaps v reached with ei English words as an array
+  # (of int64, unless f is too long for them), and the sums for them. Each
+  # alignment extends all compatible v at once, and the extensions that end
+  # at ej are added up by logadd10_by_key when ej is reached.
+  write("\nDYNAMIC PROGRAMMING SUM OVER ALIGNMENTS\n",2)
+  masks = span_masks(len(f))
+  dtype = np.int64 if len(f) < 63 else object
+  extensions = [[] for _ in e] + [[]]
+  extensions[0].append((np.zeros(1, dtype), np.zeros(1)))
+  chart = [None for _ in e] + [None]
+  for ei in xrange(len(e)+1):
+    if extensions[ei]:
+      chart[ei] = logadd10_by_key(np.concatenate([vs for (vs, _) in extensions[ei]]),
+                                  np.concatenate([sums for (_, sums) in extensions[ei]]))
+    else:
+      chart[ei] = (np.zeros(0, dtype), np.zeros(0))
+    extensions[ei] = None
+    if ei == len(e):
+      break
+    (vs, sums) = chart[ei]
+    for ej, logprob, fi, fj in alignments[ei]:
+      compatible = (vs & masks[fi][fj]) == 0
+      if compatible.any():
+        extensions[ej].append((vs[compatible] | masks[fi][fj], sums[compatible] + logprob))
+    if opts.logfile or opts.verbosity > 2:
+      for v, v_sum in zip(vs, sums):
+        for ej, logprob, fi, fj in alignments[ei]:
+          if masks[fi][fj] & v == 0:
+            new_v = masks[fi][fj] | v
+            write("(%d, %s): %f + (%d, %d, %s): %f -> (%d, %s): %f\n" % 
+              (ei, bitmap2str(v,len(f)), v_sum, 
+               ei, ej, bitmap2str(masks[fi][fj],len(f)), logprob, 
+               ej, bitmap2str(new_v,len(f)), v_sum+logprob), 2)
+    write(".",0)
+    write("\n",2)
+  goal = masks[0][len(f)]
+  (vs, sums) = chart[len(e)]
+  found = np.flatnonzero(vs == goal)
+  tm_logprob = None
+  if len(found):
+    tm_logprob = sums[found[0]]
+    write("\nTOTAL TM LOGPROB: %f\n" % tm_logprob,0)
   else:
-    sys.stdout.write("ERROR: COULD NOT ALIGN SENTENCE %d\n" % sent_num)
+    write("ERROR: COULD NOT ALIGN SENTENCE %d\n" % sent_num,None)
+  write("\n\n",2)
+  return (lm_logprob, tm_logprob, output)
+
+def score_in_worker((sent_num, f, e)):
+  return score(sent_num, f, e)
+
+maybe_write("Aligning...\n",0)
+maybe_write("NOTE: TM logprobs may be positive since they do not include segmentation\n",0)
+pairs = [(sent_num, f, e) for (sent_num, (f, e)) in enumerate(zip(french, english))]
+if opts.workers > 1:
+  # tm and lm are loaded above, before the pool forks, so the workers share
+  # them copy-on-write. imap returns the scores in input order, and the
+  # output of each sentence is written here, so it is the same as with one
+  # process, and so are the totals, which are added up in the same order.
+  import multiprocessing
+  pool = multiprocessing.Pool(opts.workers)
+  results = pool.imap(score_in_worker, pairs)
+else:
+  results = (score(*pair) for pair in pairs)
+total_logprob = 0.0
+unaligned_sentences = 0
+for (lm_logprob, tm_logprob, output) in results:
+  for (s, verbosity) in output:
+    if verbosity is None:
+      sys.stdout.write(s)
+    else:
+      maybe_write(s, verbosity)
+  total_logprob += lm_logprob
+  if tm_logprob is None:
     unaligned_sentences += 1
-  maybe_write("\n\n",2)
+  else:
+    total_logprob += tm_logprob
+if opts.workers > 1:
+  pool.close()
+  pool.join()
 
 sys.stdout.write("\nTotal corpus log probability (LM+TM): %f\n" % (total_logprob))
 if (len(french) != len(english)):
@@ -0,0 +1,25 @@
+#!/usr/bin/env python
+"""
+Compile counts files once into mmap'able double-array tries holding the
+counts, N and maxlen, so that the segmenter does not re-parse them on
+every run:
+
+    python compile-counts.py
+
+writes data/count_1w.trie and data/count_2w.trie, which default.py
+then picks up automatically (see models.load_pdist).
+"""
+import sys, optparse, os
+import models
+
+optparser = optparse.OptionParser(usage="%prog [options] [countsfile ...]")
+optparser.add_option("-c", "--unigramcounts", dest='counts1w', default=os.path.join('data', 'count_1w.txt'), help="unigram counts")
+optparser.add_option("-b", "--bigramcounts", dest='counts2w', default=os.path.join('data', 'count_2w.txt'), help="bigram counts")
+(opts, args) = optparser.parse_args()
+
+for counts in args or [opts.counts1w, opts.counts2w]:
+    output = models.compiled_name(counts)
+    sys.stderr.write("Compiling %s...\n" % (counts,))
+    trie = models.DoubleArrayTrie.build(models.Pdist(counts))
+    trie.save(output)
+    sys.stderr.write("Wrote %d keys (%d slots) to %s\n" % (len(trie), trie.size, output))
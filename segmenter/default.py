@@ -1,43 +1,165 @@
 
-import sys, codecs, optparse, os
+import sys, optparse, os, math, time
+import numpy as np
+import models
 
 optparser = optparse.OptionParser()
 optparser.add_option("-c", "--unigramcounts", dest='counts1w', default=os.path.join('data', 'count_1w.txt'), help="unigram counts")
 optparser.add_option("-b", "--bigramcounts", dest='counts2w', default=os.path.join('data', 'count_2w.txt'), help="bigram counts")
 optparser.add_option("-i", "--inputfile", dest="input", default=os.path.join('data', 'input'), help="input file to segment")
+optparser.add_option("-j", "--jobs", dest="jobs", default=1, type="int", help="number of worker processes (default=1)")
+optparser.add_option("--shard-bytes", dest="shard_bytes", default=16<<20, type="int", help="maximum size of a shard of the input handed to a worker with -j (default=16MB)")
+optparser.add_option("--cache-size", dest="cache_size", default=100000, type="int", help="number of distinct lines whose segmentation is cached, 0 to disable (default=100000)")
+optparser.add_option("--cache-file", dest="cache_file", default=None, help="file that keeps cached segmentations across runs (default=none)")
 (opts, _) = optparser.parse_args()
 
-class Pdist(dict):
-    "A probability distribution estimated from counts in datafile."
-
-    def __init__(self, filename, sep='\t', N=None, missingfn=None):
-        self.maxlen = 0 
-        for line in file(filename):
-            (key, freq) = line.split(sep)
-            try:
-                utf8key = unicode(key, 'utf-8')
-            except:
-                raise ValueError("Unexpected error %s" % (sys.exc_info()[0]))
-            self[utf8key] = self.get(utf8key, 0) + int(freq)
-            self.maxlen = max(len(utf8key), self.maxlen)
-        self.N = float(N or sum(self.itervalues()))
-        self.missingfn = missingfn or (lambda k, N: 1./N)
-
-    def __call__(self, key):
-        if key in self: return float(self[key])/float(self.N)
-        #else: return self.missingfn(key, self.N)
-        elif len(key) == 1: return self.missingfn(key, self.N)
-        else: return None
-
-# the default segmenter does not use any probabilities, but you could ...
-Pw  = Pdist(opts.counts1w)
-
-old = sys.stdout
-sys.stdout = codecs.lookup('utf-8')[-1](sys.stdout)
-# ignoring the dictionary provided in opts.counts
-with open(opts.input) as f:
-    for line in f:
-        utf8line = unicode(line.strip(), 'utf-8')
-        output = [i for i in utf8line]  # segmentation is one word per character in the input
-        print " ".join(output)
-sys.stdout = old
+# load_pdist uses data/count_*.trie instead if compile-counts.py was run
+Pw  = models.load_pdist(opts.counts1w)
+P2w = models.load_pdist(opts.counts2w)
+# <S> is not a unigram, so its count is the mass of the <S> bigrams
+start_count = sum(count for (_, count) in P2w.with_prefix(u'<S> '))
+
+def logcPw(word, prev):
+    "Log probability of word given the previous word, backing off to the unigram Pw(word)."
+    bigram = P2w.get(prev + u' ' + word)
+    if bigram is not None:
+        prev_count = start_count if prev == u'<S>' else Pw.get(prev)
+        if prev_count:
+            return math.log(float(bigram) / prev_count)
+    return math.log(Pw(word))
+
+# chart[j, k] is the best log probability of a segmentation of text[:j]
+# whose last word has length k+1, and back[j, k] the length of the word
+# before that one (0 at the start of the sentence). The arrays are
+# allocated once and grown when a longer line comes along.
+maxlen = max(Pw.maxlen, 1)
+chart = np.empty((1, maxlen))
+back = np.zeros((1, maxlen), dtype=np.int32)
+
+def segment(text):
+    "Return the most likely list of words for text by Viterbi search."
+    global chart, back
+    n = len(text)
+    if n == 0:
+        return []
+    if chart.shape[0] < n+1:
+        chart = np.empty((2*(n+1), maxlen))
+        back = np.zeros((2*(n+1), maxlen), dtype=np.int32)
+    chart[:n+1].fill(-np.inf)
+    for i in xrange(n):
+        if i == 0:
+            prev_lens = [0]
+            prev_words = [u'<S>']
+            prev_scores = np.zeros(1)
+        else:
+            prev_lens = np.flatnonzero(chart[i] > -np.inf) + 1
+            if len(prev_lens) == 0:
+                continue
+            prev_words = [text[i-k:i] for k in prev_lens]
+            prev_scores = chart[i, prev_lens-1]
+        # dictionary words starting at i, and the single character
+        # which is always a candidate (scored by Pw.missingfn if unseen)
+        ends = [end for (end, _) in Pw.prefixes(text, i) if end-i <= maxlen]
+        if i+1 not in ends:
+            ends.append(i+1)
+        for j in ends:
+            word = text[i:j]
+            scores = prev_scores + np.fromiter((logcPw(word, prev) for prev in prev_words), np.float64, len(prev_words))
+            best = scores.argmax()
+            chart[j, j-i-1] = scores[best]
+            back[j, j-i-1] = prev_lens[best]
+    words = []
+    (j, k) = (n, chart[n].argmax() + 1)
+    while j > 0:
+        words.append(text[j-k:j])
+        (j, k) = (j-k, back[j, k-1])
+    words.reverse()
+    return words
+
+def segment_lines(f, end=None):
+    "Yield (characters, segmented line) for each line of f, stopping at byte offset end."
+    while end is None or f.tell() < end:
+        line = f.readline()
+        if not line:
+            break
+        line = line.strip()
+        utf8line = unicode(line, 'utf-8')
+        # repeated lines (boilerplate, headlines) skip the search
+        segmented = cache.get(line) if cache else None
+        if segmented is None:
+            segmented = u" ".join(segment(utf8line)).encode('utf-8')
+            if cache:
+                cache.put(line, segmented)
+        yield (len(utf8line), segmented + "\n")
+
+def shards(filename, n):
+    "Split filename into n byte ranges (start, end) that begin and end on line boundaries."
+    size = os.path.getsize(filename)
+    bounds = [0]
+    with open(filename, 'rb') as f:
+        for k in xrange(1, n):
+            f.seek(max(size*k//n - 1, bounds[-1]))
+            f.readline()
+            if f.tell() > bounds[-1]:
+                bounds.append(f.tell())
+    if bounds[-1] < size:
+        bounds.append(size)
+    return zip(bounds[:-1], bounds[1:])
+
+def segment_shard(bounds):
+    """
+    Segment one shard of opts.input in a worker. Returns the output, the
+    number of lines and characters, and the cache hits, misses and new
+    entries for the parent to record.
+    """
+    (start, end) = bounds
+    (output, chars) = ([], 0)
+    if cache:
+        (cache.hits, cache.misses, cache.added) = (0, 0, [])
+    with open(opts.input, 'rb') as f:
+        f.seek(start)
+        for (n, segmented) in segment_lines(f, end):
+            output.append(segmented)
+            chars += n
+    if cache:
+        return ("".join(output), len(output), chars, cache.hits, cache.misses, cache.added)
+    return ("".join(output), len(output), chars, 0, 0, [])
+
+# the store of a --cache-file is only reused with the same count files
+model = models.model_identity(opts.counts1w, opts.counts2w)
+cache = models.SegmentCache(opts.cache_size, opts.cache_file, model) if opts.cache_size > 0 else None
+
+(lines, chars, start) = (0, 0, time.time())
+if opts.jobs > 1:
+    # Pw and P2w are loaded above, before the pool forks, so every worker
+    # shares them (mmap'ed tables are shared through the page cache).
+    # Use several shards per worker so that no worker waits on a slow one,
+    # and write the shards back in input order. Each worker caches the
+    # lines it sees on its own, starting from the parent's cache.
+    import multiprocessing
+    pool = multiprocessing.Pool(opts.jobs)
+    nshards = max(4*opts.jobs, os.path.getsize(opts.input) // opts.shard_bytes)
+    (hits, misses) = (0, 0)
+    for (output, n, m, h, mi, added) in pool.imap(segment_shard, shards(opts.input, nshards)):
+        sys.stdout.write(output)
+        lines += n
+        chars += m
+        (hits, misses) = (hits + h, misses + mi)
+        if cache:
+            cache.add(added)
+    pool.close()
+    pool.join()
+    if cache:
+        (cache.hits, cache.misses) = (hits, misses)
+else:
+    with open(opts.input, 'rb') as f:
+        for (n, segmented) in segment_lines(f):
+            sys.stdout.write(segmented)
+            lines += 1
+            chars += n
+elapsed = max(time.time() - start, 1e-9)
+sys.stderr.write("Segmented %d lines (%d chars) in %.2f sec: %.0f chars/sec, %.1f lines/sec\n" %
+  (lines, chars, elapsed, chars/elapsed, lines/elapsed))
+if cache:
+    cache.close()
+    sys.stderr.write("%s\n" % cache.stats())
@@ -0,0 +1,425 @@
+#!/usr/bin/env python
+# Data structures for the word segmenter
+import sys, os, struct, mmap, array, ctypes, hashlib
+from collections import OrderedDict
+
+class Pdist(dict):
+    "A probability distribution estimated from counts in datafile."
+
+    def __init__(self, filename, sep='\t', N=None, missingfn=None):
+        self.maxlen = 0
+        for line in file(filename):
+            (key, freq) = line.split(sep)
+            try:
+                utf8key = unicode(key, 'utf-8')
+            except:
+                raise ValueError("Unexpected error %s" % (sys.exc_info()[0]))
+            self[utf8key] = self.get(utf8key, 0) + int(freq)
+            self.maxlen = max(len(utf8key), self.maxlen)
+        self.N = float(N or sum(self.itervalues()))
+        self.missingfn = missingfn or (lambda k, N: 1./N)
+
+    def __call__(self, key):
+        if key in self: return float(self[key])/float(self.N)
+        #else: return self.missingfn(key, self.N)
+        elif len(key) == 1: return self.missingfn(key, self.N)
+        else: return None
+
+    def prefixes(self, text, start=0):
+        "Yield (end, count) for every key that matches text[start:end]."
+        for end in xrange(start+1, min(len(text), start+self.maxlen)+1):
+            if text[start:end] in self:
+                yield (end, self[text[start:end]])
+
+    def with_prefix(self, prefix):
+        "Yield (key, count) for every key that starts with prefix."
+        return ((k, v) for (k, v) in self.iteritems() if k.startswith(prefix))
+
+class MappedPdist:
+    """
+    A probability distribution read lazily from a counts file compiled
+    by compile-counts.py. The file is mmap'ed, so opening it costs
+    nothing and the counts, N and maxlen are never parsed.
+    """
+
+    def __init__(self, filename, N=None, missingfn=None):
+        self.trie = DoubleArrayTrie.load(filename)
+        self.maxlen = self.trie.maxlen
+        self.N = float(N or self.trie.total)
+        self.missingfn = missingfn or (lambda k, N: 1./N)
+        # lookups go straight to the trie rather than through a wrapper
+        self.memo = self.trie.memo
+        self.get = self.trie.get
+        self.prefixes = self.trie.prefixes
+        self.with_prefix = self.trie.with_prefix
+
+    def __len__(self): return len(self.trie)
+    def __contains__(self, key): return key in self.trie
+    def __getitem__(self, key): return self.trie[key]
+
+    def __call__(self, key):
+        freq = self.memo[key]
+        if freq >= 0: return freq/self.N
+        elif len(key) == 1: return self.missingfn(key, self.N)
+        else: return None
+
+def compiled_name(filename):
+    return os.path.splitext(filename)[0] + '.trie'
+
+def is_compiled(filename):
+    with open(filename, 'rb') as f:
+        return f.read(len(TRIE_MAGIC)) == TRIE_MAGIC
+
+def load_pdist(filename, **kwargs):
+    """
+    Return a MappedPdist if filename is a compiled counts file or has an
+    up to date compiled copy next to it, and parse it with Pdist otherwise.
+    """
+    if is_compiled(filename):
+        return MappedPdist(filename, **kwargs)
+    compiled = compiled_name(filename)
+    if os.path.exists(compiled) and os.path.getmtime(compiled) >= os.path.getmtime(filename):
+        return MappedPdist(compiled, **kwargs)
+    return Pdist(filename, **kwargs)
+
+# A double-array trie maps unicode keys to counts using two int32
+# arrays: moving from state s on character code c goes to state
+# t = base[s] + c, which is valid only if check[t] == s. Characters are
+# mapped to dense codes 1..A (most frequent character first) so that
+# the arrays stay small for large alphabets like Chinese. The trie
+# lives in one flat buffer laid out as
+#
+#   header | alphabet (utf-8) | base[size] | check[size] | value[size]
+#
+# so a compiled file can be mmap'ed and shared between any number of
+# processes without being parsed. value[s] is the count of the key
+# ending at state s, or -1 if no key ends there. The three arrays are
+# read through ctypes arrays laid over the buffer, which index like
+# lists without copying or unpacking anything up front.
+TRIE_MAGIC = 'DATRIE01'
+trie_header = struct.Struct('<8siiid')
+le_int32 = ctypes.c_int32.__ctype_le__
+le_double = ctypes.c_double.__ctype_le__
+
+class DoubleArrayTrie:
+    def __init__(self, buf, memo_size=1<<16):
+        if not isinstance(buf, (mmap.mmap, bytearray)):
+            buf = bytearray(buf) # ctypes only lays arrays over writable buffers
+        self.buf = buf
+        (magic, self.size, self.nkeys, self.maxlen, self.total) = trie_header.unpack_from(buf, 0)
+        if magic != TRIE_MAGIC:
+            raise ValueError("not a compiled trie (bad magic %r)" % (magic,))
+        offset = trie_header.size
+        (nbytes,) = struct.unpack_from('<i', buf, offset)
+        offset += 4
+        alphabet = unicode(str(buf[offset:offset+nbytes]), 'utf-8')
+        self.alphabet = alphabet
+        self.code = dict((ch, i+1) for (i, ch) in enumerate(alphabet))
+        offset += nbytes + (-(offset+nbytes) % 8)
+        self._check = offset + 4*self.size
+        self.base = (le_int32 * self.size).from_buffer(buf, offset)
+        self.check = (le_int32 * self.size).from_buffer(buf, self._check)
+        self.value = (le_double * self.size).from_buffer(buf, self._check + 4*self.size)
+        self.memo = TrieMemo(self, memo_size)
+
+    @classmethod
+    def load(cls, filename):
+        "Map a compiled trie file into memory without reading it."
+        # copy-on-write rather than read-only, since ctypes refuses
+        # read-only buffers; nothing ever writes, so pages stay shared
+        with open(filename, 'rb') as f:
+            return cls(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_COPY))
+
+    @classmethod
+    def build(cls, counts):
+        "Build a trie from a dict of unicode key -> count."
+        return cls(compile_trie(counts))
+
+    def save(self, filename):
+        with open(filename, 'wb') as f:
+            f.write(self.buf[:])
+
+    def __len__(self):
+        return self.nkeys
+
+    def _walk(self, chars):
+        "Return the state reached from the root on chars, or -1 if there is none."
+        (code, base, check, size) = (self.code, self.base, self.check, self.size)
+        s = 0
+        for ch in chars:
+            t = base[s] + code.get(ch, size) # unknown characters land past the end
+            if t >= size or check[t] != s:
+                return -1
+            s = t
+        return s
+
+    def get(self, key, default=None):
+        v = self.memo[key]
+        return default if v < 0 else v
+
+    def __contains__(self, key):
+        return self.get(key) is not None
+
+    def __getitem__(self, key):
+        v = self.get(key)
+        if v is None:
+            raise KeyError(key)
+        return v
+
+    def _children(self, s):
+        "Yield (character, state) for every transition out of state s."
+        b = self.base[s]
+        if b == 0:
+            return
+        # children of s are the slots b+c with check == s; search the
+        # raw check array for s rather than probing every code c
+        owner = struct.pack('<i', s)
+        end = self._check + 4*min(b + len(self.alphabet) + 1, self.size)
+        pos = self.buf.find(owner, self._check + 4*(b+1), end)
+        while pos >= 0:
+            if (pos - self._check) % 4 == 0:
+                t = (pos - self._check) // 4
+                yield (self.alphabet[t-b-1], t)
+                pos = self.buf.find(owner, pos+4, end)
+            else:
+                pos = self.buf.find(owner, pos+1, end)
+
+    def with_prefix(self, prefix):
+        "Yield (key, count) for every key that starts with prefix."
+        s = self._walk(prefix)
+        if s < 0:
+            return
+        agenda = [(prefix, s)]
+        while agenda:
+            (key, s) = agenda.pop()
+            v = self.value[s]
+            if v >= 0:
+                yield (key, v)
+            for (ch, t) in self._children(s):
+                agenda.append((key + ch, t))
+
+    def prefixes(self, text, start=0):
+        "Yield (end, count) for every key equal to text[start:end], in one walk."
+        (code, base, check, value, size) = (self.code, self.base, self.check, self.value, self.size)
+        s = 0
+        for end in xrange(start+1, len(text)+1):
+            t = base[s] + code.get(text[end-1], size)
+            if t >= size or check[t] != s:
+                return
+            s = t
+            v = value[s]
+            if v >= 0:
+                yield (end, v)
+
+class TrieMemo(dict):
+    """
+    The counts of recently looked up keys (-1 for absent keys). Walking
+    the trie costs a few array reads per character, while the segmenter
+    asks for the same words and bigrams over and over, so lookups go
+    through this dict and only walk the trie for keys it has not seen.
+    """
+
+    def __init__(self, trie, size):
+        self.trie = trie
+        self.size = size
+
+    def __missing__(self, key):
+        s = self.trie._walk(key)
+        v = self.trie.value[s] if s >= 0 else -1.0
+        if len(self) >= self.size:
+            self.clear()
+        self[key] = v
+        return v
+
+def compile_trie(counts):
+    "Lay out a double-array trie for counts and return the flat buffer."
+    freq = {}
+    for key in counts:
+        for ch in key:
+            freq[ch] = freq.get(ch, 0) + 1
+    alphabet = sorted(freq, key=lambda ch: (-freq[ch], ch))
+    code = dict((ch, i+1) for (i, ch) in enumerate(alphabet))
+    keys = sorted((tuple(code[ch] for ch in key), counts[key]) for key in counts if len(key) > 0)
+
+    base, check, value = [0], [0], [-1.0]
+    # nextfree[i] points at a slot >= i that was free when last looked
+    # at, so that finding free slots skips over the packed region
+    nextfree = [1]
+    def grow(n):
+        while len(check) < n:
+            base.append(0)
+            check.append(-1)
+            value.append(-1.0)
+            nextfree.append(len(nextfree))
+    def free_from(i):
+        grow(i+1)
+        j = i
+        while check[j] != -1:
+            j = nextfree[j] if nextfree[j] > j else j+1
+            grow(j+1)
+        while i != j and nextfree[i] != j: # path compression
+            (nextfree[i], i) = (j, nextfree[i] if nextfree[i] > i else i+1)
+        return j
+    # each agenda item is a state and the range of sorted keys below it
+    agenda = [(0, 0, 0, len(keys))]
+    while agenda:
+        (s, depth, lo, hi) = agenda.pop()
+        if lo < hi and len(keys[lo][0]) == depth: # sorted, so the key ending here comes first
+            value[s] = float(keys[lo][1])
+            lo += 1
+        children = []
+        for i in xrange(lo, hi):
+            c = keys[i][0][depth]
+            if children and children[-1][0] == c:
+                children[-1][2] = i+1
+            else:
+                children.append([c, i, i+1])
+        if not children:
+            continue
+        # find the smallest base that puts every child on a free slot,
+        # trying only bases that put the first child on a free slot
+        c0 = children[0][0]
+        p = free_from(c0 + 1)
+        while True:
+            b = p - c0
+            grow(b + children[-1][0] + 1)
+            if all(check[b+c] == -1 for (c, _, _) in children):
+                break
+            p = free_from(p + 1)
+        base[s] = b
+        for (c, _, _) in children:
+            check[b+c] = s
+            nextfree[b+c] = b+c+1
+        for (c, clo, chi) in children:
+            agenda.append((b+c, depth+1, clo, chi))
+
+    alphabet = u"".join(alphabet).encode('utf-8')
+    base, check, value = array.array('i', base), array.array('i', check), array.array('d', value)
+    if sys.byteorder == 'big':
+        for a in (base, check, value):
+            a.byteswap()
+    header = trie_header.pack(TRIE_MAGIC, len(check), len(keys), max([len(k) for (k, _) in keys] or [0]), float(sum(counts.itervalues())))
+    header += struct.pack('<i', len(alphabet)) + alphabet
+    header += '\0' * (-len(header) % 8)
+    return header + base.tostring() + check.tostring() + value.tostring()
+
+def model_identity(*filenames):
+    "Identify the count files a model is read from by their paths, sizes and modification times."
+    return " ".join("%s:%d:%d" % (os.path.abspath(name), os.path.getsize(name), os.path.getmtime(name)) for name in filenames)
+
+class SegmentCache:
+    """
+    A bounded LRU cache from input lines to their segmentations, keyed
+    by a hash of the line so long lines cost no more than short ones.
+    With a filename, new segmentations are also appended to a store on
+    disk and the most recent ones are loaded back on the next run.
+
+    The store begins with a header naming the model that produced its
+    segmentations (see model_identity), and a store written for another
+    model is discarded. Lines that are not key-tab-segmentation records,
+    such as one cut short by an interrupted run, are skipped.
+
+    Only the process that opened the cache writes to the store. Forked
+    worker processes collect their new entries in self.added so that
+    the parent can write them with add().
+    """
+
+    def __init__(self, size, filename=None, model=''):
+        self.size = size
+        self.lru = OrderedDict()
+        (self.hits, self.misses) = (0, 0)
+        self.filename = filename
+        self.header = "#model\t%s\n" % model
+        self.added = []
+        self.records = 0
+        self.pid = os.getpid()
+        self.store = None
+        line = None
+        if filename and os.path.exists(filename):
+            with open(filename, 'rb') as f:
+                if f.readline() == self.header:
+                    for line in f:
+                        self._load(line)
+                else:
+                    sys.stderr.write("Ignoring %s, which caches segmentations of another model\n" % filename)
+                    os.remove(filename)
+        if filename:
+            exists = os.path.exists(filename)
+            self.store = open(filename, 'ab')
+            if not exists:
+                self.store.write(self.header)
+            elif line is not None and not line.endswith('\n'):
+                self.store.write('\n') # end the record an interrupted run cut short
+
+    def _load(self, line):
+        "Insert the record on line of the store, unless it is malformed."
+        if not line.endswith('\n'):
+            return
+        fields = line[:-1].split('\t', 1)
+        if len(fields) != 2 or len(fields[0]) != 2*hashlib.sha1().digest_size:
+            return
+        try:
+            key = fields[0].decode('hex')
+        except TypeError:
+            return
+        self._insert(key, fields[1])
+        self.records += 1
+
+    @staticmethod
+    def key(line):
+        return hashlib.sha1(line).digest()
+
+    def _insert(self, key, value):
+        self.lru.pop(key, None)
+        self.lru[key] = value
+        if len(self.lru) > self.size:
+            self.lru.popitem(last=False)
+
+    def get(self, line):
+        "Return the cached segmentation of line, or None."
+        key = self.key(line)
+        value = self.lru.pop(key, None)
+        if value is None:
+            self.misses += 1
+            return None
+        self.lru[key] = value # most recently used
+        self.hits += 1
+        return value
+
+    def put(self, line, segmented):
+        key = self.key(line)
+        self._insert(key, segmented)
+        if self.store is not None:
+            self.added.append((key, segmented))
+            if os.getpid() == self.pid and len(self.added) >= 1000:
+                self.add([])
+
+    def add(self, entries):
+        "Write entries (and any pending ones of our own) to the store."
+        if self.store is None:
+            return
+        for (key, value) in entries:
+            self._insert(key, value)
+        for (key, value) in self.added + entries:
+            self.store.write("%s\t%s\n" % (key.encode('hex'), value))
+        self.records += len(self.added) + len(entries)
+        self.added = []
+
+    def close(self):
+        "Flush the store, compacting it to the cached entries once it holds many stale ones."
+        if self.store is None:
+            return
+        self.add([])
+        self.store.close()
+        if self.records > 2*self.size:
+            with open(self.filename + '.tmp', 'wb') as f:
+                f.write(self.header)
+                for (key, value) in self.lru.iteritems():
+                    f.write("%s\t%s\n" % (key.encode('hex'), value))
+            os.rename(self.filename + '.tmp', self.filename)
+        self.store = None
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return "Cache: %d hits, %d misses (%.1f%% hit rate), %d entries" % (
+            self.hits, self.misses, 100.0 * self.hits / lookups if lookups else 0.0, len(self.lru))
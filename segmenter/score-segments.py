@@ -1,23 +1,13 @@
 from __future__ import division
-import optparse, sys, codecs
-from collections import defaultdict
+import optparse, sys
+from itertools import izip_longest
 
 optparser = optparse.OptionParser()
 optparser.add_option("-t", "--testfile", dest="testfile", default=None, help="Output from your segmenter program")
 optparser.add_option("-r", "--referencefile", dest="referencefile", default="data/reference", help="Reference segmentation")
+optparser.add_option("-p", "--progress", dest="progress", default=0, type="int", help="report the running score on stderr every this many lines (default=0, no reports)")
 (opts, _) = optparser.parse_args()
 
-if opts.testfile is None:
-    test = list(sys.stdin)
-else:
-    with open(opts.testfile) as f:
-        test = list(f)
-with open(opts.referencefile) as f:
-    reference = list(f)
-
-if len(test) != len(reference):
-    raise ValueError("Error: output and reference do not have identical number of lines")
-
 def precision(reference, test):
     if len(test) == 0:
         return None
@@ -39,28 +29,37 @@ def fmeasure(reference, test, alpha=0.5):
         return 0
     return 1.0/(alpha/p + (1-alpha)/r)
 
-def corpus_fmeasure(reference, test):
+def corpus_fmeasure(reference, test, progress=0):
     """ 
     assumes that the input lines are in UTF-8
     used to compute f-measure for Chinese word segmentation
-    sys.stdout is temporarily changed to enable debugging of UTF-8
+    reference and test are read one line at a time, so they can be
+    streams (e.g. a pipe from the segmenter) of any length
     """
-    old = sys.stdout
-    sys.stdout = codecs.lookup('utf-8')[-1](sys.stdout)
     score = 0 
-    for i in range(len(reference)):
-        reference_len, test_len = 0,0
-        for w in unicode(reference[i], 'utf-8').split():
-            reference_len += len(w)
-        for w in unicode(test[i], 'utf-8').split():
-            test_len += len(w)
-        test_utf8 = set(unicode(test[i], 'utf-8').split())
-        reference_utf8 = set(unicode(reference[i], 'utf-8').split())
+    n = 0
+    for (reference_line, test_line) in izip_longest(reference, test):
+        if reference_line is None or test_line is None:
+            raise ValueError("Error: output and reference do not have identical number of lines")
+        reference_utf8 = unicode(reference_line, 'utf-8').split()
+        test_utf8 = unicode(test_line, 'utf-8').split()
+        reference_len = sum(len(w) for w in reference_utf8)
+        test_len = sum(len(w) for w in test_utf8)
+        test_utf8 = set(test_utf8)
+        reference_utf8 = set(reference_utf8)
         if (reference_len != test_len) or (len(test_utf8) == 0): 
             test_utf8 = set(['empty'])
         score += fmeasure(reference_utf8, test_utf8)
-    #print "Score: %.2f" % ((score/len(test))*100)
-    sys.stdout = old 
-    return ((score/len(test))*100)
+        n += 1
+        if progress and n % progress == 0:
+            sys.stderr.write("%d lines, running score: %.2f\n" % (n, (score/n)*100))
+    if n == 0:
+        raise ValueError("Error: no lines to score")
+    return ((score/n)*100)
 
-print "Score: %.2f" % corpus_fmeasure(reference, test)
+with open(opts.referencefile) as reference:
+    if opts.testfile is None:
+        print "Score: %.2f" % corpus_fmeasure(reference, sys.stdin, opts.progress)
+    else:
+        with open(opts.testfile) as test:
+            print "Score: %.2f" % corpus_fmeasure(reference, test, opts.progress)